@@ -0,0 +1,98 @@
+import os
+import threading
+import numpy as np
+
+
+class ClassificationIdIndex:
+    """
+    Compact set of integer classification IDs that can be persisted between
+    runs. IDs are held in a sorted int64 array; newly added IDs are collected
+    in a small delta buffer that is merged into the sorted array when it
+    exceeds `maxDeltaSize` entries.
+    """
+
+    def __init__(self, path=None, maxDeltaSize=4096):
+        """
+        Args:
+        path - Optional path of a `.npy` file from which the index is loaded
+        (if it exists) and to which it is saved.
+        maxDeltaSize - The number of buffered IDs that triggers a merge.
+        """
+        self.path = path
+        self.maxDeltaSize = maxDeltaSize
+        self.lock = threading.Lock()
+        self.sortedIds = np.empty(0, dtype=np.int64)
+        self.deltaIds = []
+        self.deltaSize = 0
+        if self.path is not None and os.path.isfile(self.path):
+            self.sortedIds = np.unique(np.load(self.path).astype(np.int64))
+            print(
+                "ClassificationIdIndex: Loaded {} classification IDs from {}".format(
+                    self.sortedIds.size, self.path
+                )
+            )
+
+    def __len__(self):
+        with self.lock:
+            self.merge()
+            return self.sortedIds.size
+
+    @staticmethod
+    def toIdArray(classificationIds):
+        return np.asarray(classificationIds, dtype=np.int64).ravel()
+
+    def contains(self, classificationIds):
+        """
+        Return a boolean array indicating which of `classificationIds` are
+        present in the index.
+        """
+        classificationIds = ClassificationIdIndex.toIdArray(classificationIds)
+        with self.lock:
+            positions = np.searchsorted(self.sortedIds, classificationIds)
+            found = np.zeros(classificationIds.size, dtype=bool)
+            inRange = positions < self.sortedIds.size
+            found[inRange] = (
+                self.sortedIds[positions[inRange]] == classificationIds[inRange]
+            )
+            if self.deltaSize:
+                found |= np.isin(classificationIds, np.concatenate(self.deltaIds))
+        return found
+
+    def add(self, classificationIds):
+        classificationIds = ClassificationIdIndex.toIdArray(classificationIds)
+        if not classificationIds.size:
+            return
+        with self.lock:
+            self.deltaIds.append(classificationIds)
+            self.deltaSize += classificationIds.size
+            if self.deltaSize > self.maxDeltaSize:
+                self.merge()
+
+    def merge(self):
+        # Must be called with the lock held
+        if self.deltaSize:
+            self.sortedIds = np.union1d(self.sortedIds, np.concatenate(self.deltaIds))
+            self.deltaIds = []
+            self.deltaSize = 0
+
+    def save(self, path=None, excludeIds=None):
+        """
+        Write the index to `path` (default: the path it was created with).
+        IDs in `excludeIds` are omitted from the saved file but are retained
+        in memory.
+        """
+        path = path if path is not None else self.path
+        if path is None:
+            return
+        with self.lock:
+            self.merge()
+            savedIds = self.sortedIds
+        if excludeIds is not None and len(excludeIds):
+            savedIds = np.setdiff1d(
+                savedIds, ClassificationIdIndex.toIdArray(excludeIds)
+            )
+        # Write to a temporary file first so that an interrupted save cannot
+        # corrupt an existing index.
+        tempPath = path + ".tmp.npy"
+        np.save(tempPath, savedIds)
+        os.replace(tempPath, path)
@@ -0,0 +1,112 @@
+import numpy as np
+
+from .ClassificationIdIndex import ClassificationIdIndex
+
+
+class ClassificationStore:
+    """
+    Append-only store of the classifications processed by `SQSMessageParser`.
+
+    Each append adds a chunk of typed per-classification columns and a flat
+    table of the classifications' (filtered) marks, so appending costs
+    O(batch) regardless of the number of classifications already stored.
+    Classifications whose IDs are already stored are dropped on append.
+    """
+
+    classificationColumns = [
+        "id",
+        "subject_id",
+        "user_id",
+        "image_width",
+        "image_height",
+        "box_widths",
+        "box_heights",
+        "num_marks",
+    ]
+    markColumns = ["x", "y", "tool"]
+    emptyDtypes = {
+        "id": np.int64,
+        "subject_id": np.int64,
+        "user_id": np.int64,
+        "num_marks": np.int64,
+        "tool": np.int64,
+    }
+
+    def __init__(self):
+        self.ids = ClassificationIdIndex()
+        self.chunks = []
+        self.numClassifications = 0
+        self.concatenated = None
+
+    def __len__(self):
+        return self.numClassifications
+
+    def append(
+        self,
+        ids,
+        subjectIds,
+        userIds,
+        imageDimensions,
+        boxWidths,
+        boxHeights,
+        markings,
+        tools,
+    ):
+        """
+        Append a batch of classifications. `imageDimensions` holds a (width,
+        height) tuple per classification, and `markings` and `tools` hold the
+        (x, y) marks of each classification and the tool of each mark.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        # Keep the first of any repeated IDs, as drop_duplicates would
+        _, firstRows = np.unique(ids, return_index=True)
+        firstRows.sort()
+        rows = firstRows[~self.ids.contains(ids[firstRows])]
+        if not rows.size:
+            return
+        self.ids.add(ids[rows])
+
+        rowList = rows.tolist()
+        numMarks = np.array([len(markings[row]) for row in rowList], dtype=np.int64)
+        marks = np.array(
+            [mark[:2] for row in rowList for mark in markings[row]], dtype=float
+        ).reshape(-1, 2)
+        markTools = [tool for row in rowList for tool in tools[row]]
+        # The dimensions and tools are stored with whatever dtype numpy infers,
+        # so that their values are emitted unchanged.
+        chunk = {
+            "id": ids[rows],
+            "subject_id": np.asarray(subjectIds)[rows],
+            "user_id": np.asarray(userIds, dtype=np.int64)[rows],
+            "image_width": np.array([imageDimensions[row][0] for row in rowList]),
+            "image_height": np.array([imageDimensions[row][1] for row in rowList]),
+            "box_widths": np.asarray(boxWidths, dtype=float)[rows],
+            "box_heights": np.asarray(boxHeights, dtype=float)[rows],
+            "num_marks": numMarks,
+            "x": marks[:, 0],
+            "y": marks[:, 1],
+            "tool": np.array(markTools)
+            if markTools
+            else np.empty(0, dtype=np.int64),
+        }
+        self.chunks.append(chunk)
+        self.numClassifications += rows.size
+        self.concatenated = None
+
+    def columns(self):
+        """
+        Return a dict of the stored columns, concatenated across chunks. The
+        per-classification columns have one entry per classification, and the
+        mark columns have one entry per mark.
+        """
+        if self.concatenated is None:
+            self.concatenated = {
+                name: np.concatenate([chunk[name] for chunk in self.chunks])
+                if self.chunks
+                else np.empty(0, dtype=self.emptyDtypes.get(name, float))
+                for name in self.classificationColumns + self.markColumns
+            }
+            if len(self.chunks) > 1:
+                # Merge the chunks so that later calls are cheap
+                self.chunks = [dict(self.concatenated)]
+        return self.concatenated
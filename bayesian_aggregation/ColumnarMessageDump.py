@@ -0,0 +1,384 @@
+import argparse
+import bisect
+import collections.abc
+import json
+import os
+import pickle
+import numbers
+import shutil
+import numpy as np
+
+
+class ColumnarMessageDump:
+    """
+    Columnar, memory-mappable representation of a dump of Caesar messages.
+
+    A dump is a directory of `.npy` files: one row per classification holding
+    flattened scalar fields, and a packed marks table with one row per mark
+    holding (classification row, task, x, y, tool). Subject metadata is kept
+    as packed JSON for exact reconstruction. In addition, every scalar subject
+    metadata field is stored as a numeric or categorical column so that it can
+    be filtered on without decoding the JSON.
+
+    Messages are materialised on demand in the projected form produced by
+    `MessageDecoder.project`, which holds every field the aggregator uses.
+    """
+
+    version = 1
+    # String metadata fields with more distinct values than this are only
+    # available via the packed JSON.
+    maxCategories = 4096
+
+    def __init__(self, path, mmap=True):
+        self.path = str(path)
+        with open(os.path.join(self.path, "meta.json")) as metaFile:
+            self.meta = json.load(metaFile)
+        self.tasks = self.meta["tasks"]
+        self.columns = {
+            os.path.splitext(columnFile)[0]: np.load(
+                os.path.join(self.path, columnFile), mmap_mode="r" if mmap else None
+            )
+            for columnFile in os.listdir(self.path)
+            if columnFile.endswith(".npy")
+        }
+
+    def __len__(self):
+        return self.meta["numClassifications"]
+
+    @staticmethod
+    def isColumnarDump(path):
+        return os.path.isfile(os.path.join(path, "meta.json"))
+
+    def metadataColumn(self, key):
+        """
+        Return the column for the subject metadata field `key` as a float array
+        (numeric fields, NaN where missing) or an array of category codes
+        (string fields, -1 where missing) with the list of categories. Returns
+        None if there is no column for the field.
+        """
+        if key not in self.meta["metadataColumns"]:
+            return None
+        columnInfo = self.meta["metadataColumns"][key]
+        column = self.columns["metadata_{}".format(columnInfo["index"])]
+        if columnInfo["kind"] == "numeric":
+            return column
+        return column, columnInfo["categories"]
+
+    def subjectMetadata(self, row):
+        offsets = self.columns["subject_metadata_offsets"]
+        return json.loads(
+            self.columns["subject_metadata_bytes"][offsets[row] : offsets[row + 1]]
+            .tobytes()
+            .decode()
+        )
+
+    def annotations(self, row):
+        markOffsets = self.columns["mark_offsets"]
+        markSlice = slice(markOffsets[row], markOffsets[row + 1])
+        markTasks = self.columns["mark_task"][markSlice]
+        markX = self.columns["mark_x"][markSlice]
+        markY = self.columns["mark_y"][markSlice]
+        markTools = self.columns["mark_tool"][markSlice]
+        annotations = {}
+        for taskIndex in np.flatnonzero(self.columns["task_present"][row]):
+            taskLabel = self.tasks[taskIndex]
+            annotations[taskLabel] = [
+                {
+                    "task": taskLabel,
+                    "value": [
+                        {
+                            "x": float(x),
+                            "y": float(y),
+                            "tool": int(tool) if tool >= 0 else None,
+                        }
+                        for x, y, tool in zip(
+                            markX[markTasks == taskIndex],
+                            markY[markTasks == taskIndex],
+                            markTools[markTasks == taskIndex],
+                        )
+                    ],
+                }
+            ]
+        return annotations
+
+    def message(self, row):
+        classificationId = int(self.columns["classification_id"][row])
+        userId = (
+            int(self.columns["user_id"][row])
+            if self.columns["has_user_id"][row]
+            else None
+        )
+        subjectId = int(self.columns["subject_id"][row])
+        naturalWidth = self.columns["natural_width"][row]
+        naturalHeight = self.columns["natural_height"][row]
+        subjectDimensions = []
+        if np.isfinite(naturalWidth) and np.isfinite(naturalHeight):
+            # Dimensions that were integers are restored as integers
+            if (
+                "natural_dims_integral" in self.columns
+                and self.columns["natural_dims_integral"][row]
+            ):
+                dimensionType = int
+            else:
+                dimensionType = float
+            subjectDimensions.append(
+                {
+                    "naturalWidth": dimensionType(naturalWidth),
+                    "naturalHeight": dimensionType(naturalHeight),
+                }
+            )
+        return {
+            "id": classificationId,
+            "classification_id": classificationId,
+            "user_id": userId,
+            "subject_id": subjectId,
+            "data": {
+                "classification": {
+                    "id": int(self.columns["id"][row]),
+                    "user_id": userId,
+                    "subject_id": subjectId,
+                    "workflow_id": None,
+                    "annotations": self.annotations(row),
+                    "metadata": {"subject_dimensions": subjectDimensions},
+                    "subject": {"id": subjectId, "metadata": self.subjectMetadata(row)},
+                }
+            },
+        }
+
+    def messages(self, rows):
+        return [self.message(row) for row in rows]
+
+    @staticmethod
+    def write(messages, path):
+        """
+        Write an iterable of Caesar message dicts to a columnar dump at `path`.
+
+        The dump is written to a temporary directory which then replaces any
+        existing dump at `path`. Readers that have memory-mapped the files of
+        the existing dump keep a consistent view of them.
+        """
+        scalars = collections.defaultdict(list)
+        marks = collections.defaultdict(list)
+        metadataBytes = bytearray()
+        metadataOffsets = [0]
+        metadataValues = collections.defaultdict(dict)
+        taskIndices = {}
+        taskPresence = []
+
+        for row, message in enumerate(messages):
+            classification = message["data"]["classification"]
+            scalars["classification_id"].append(int(message["classification_id"]))
+            scalars["id"].append(int(classification.get("id", message["classification_id"])))
+            userId = classification.get("user_id", message.get("user_id"))
+            scalars["has_user_id"].append(userId is not None)
+            scalars["user_id"].append(int(userId) if userId is not None else 0)
+            scalars["subject_id"].append(
+                int(classification.get("subject_id", message.get("subject_id")))
+            )
+
+            try:
+                imageDims = classification["metadata"]["subject_dimensions"][0]
+                naturalWidth = float(imageDims["naturalWidth"])
+                naturalHeight = float(imageDims["naturalHeight"])
+                naturalDimsIntegral = all(
+                    isinstance(imageDims[key], numbers.Integral)
+                    and not isinstance(imageDims[key], bool)
+                    for key in ("naturalWidth", "naturalHeight")
+                )
+            except (KeyError, IndexError, TypeError):
+                naturalWidth = naturalHeight = np.nan
+                naturalDimsIntegral = False
+            scalars["natural_width"].append(naturalWidth)
+            scalars["natural_height"].append(naturalHeight)
+            scalars["natural_dims_integral"].append(naturalDimsIntegral)
+
+            subjectMetadata = classification["subject"]["metadata"]
+            metadataBytes.extend(json.dumps(subjectMetadata).encode())
+            metadataOffsets.append(len(metadataBytes))
+            for key, value in subjectMetadata.items():
+                if isinstance(value, (str, numbers.Real)) and not isinstance(value, bool):
+                    metadataValues[key][row] = value
+
+            presentTasks = set()
+            for taskLabel, taskAnnotations in classification.get("annotations", {}).items():
+                # Only drawing tasks, whose values are lists of marks, are
+                # stored. The values of e.g. question tasks are not.
+                if not isinstance(taskAnnotations[0]["value"], list):
+                    continue
+                taskIndex = taskIndices.setdefault(taskLabel, len(taskIndices))
+                presentTasks.add(taskIndex)
+                for mark in taskAnnotations[0]["value"]:
+                    marks["mark_row"].append(row)
+                    marks["mark_task"].append(taskIndex)
+                    marks["mark_x"].append(float(mark["x"]))
+                    marks["mark_y"].append(float(mark["y"]))
+                    marks["mark_tool"].append(
+                        int(mark["tool"]) if mark.get("tool") is not None else -1
+                    )
+            taskPresence.append(presentTasks)
+
+        numClassifications = len(scalars["classification_id"])
+        path = str(path).rstrip(os.sep)
+        temporaryPath = "{}.tmp{}".format(path, os.getpid())
+        shutil.rmtree(temporaryPath, ignore_errors=True)
+        os.makedirs(temporaryPath)
+
+        def saveColumn(name, values, dtype):
+            np.save(
+                os.path.join(temporaryPath, name + ".npy"),
+                np.asarray(values, dtype=dtype),
+            )
+
+        for name, dtype in [
+            ("classification_id", np.int64),
+            ("id", np.int64),
+            ("user_id", np.int64),
+            ("has_user_id", bool),
+            ("subject_id", np.int64),
+            ("natural_width", np.float64),
+            ("natural_height", np.float64),
+            ("natural_dims_integral", bool),
+        ]:
+            saveColumn(name, scalars[name], dtype)
+
+        taskPresent = np.zeros((numClassifications, len(taskIndices)), dtype=bool)
+        for row, presentTasks in enumerate(taskPresence):
+            taskPresent[row, list(presentTasks)] = True
+        saveColumn("task_present", taskPresent, bool)
+
+        for name, dtype in [
+            ("mark_row", np.int64),
+            ("mark_task", np.int16),
+            ("mark_x", np.float64),
+            ("mark_y", np.float64),
+            ("mark_tool", np.int64),
+        ]:
+            saveColumn(name, marks[name], dtype)
+        saveColumn(
+            "mark_offsets",
+            np.searchsorted(
+                np.asarray(marks["mark_row"], dtype=np.int64),
+                np.arange(numClassifications + 1),
+            ),
+            np.int64,
+        )
+
+        saveColumn("subject_metadata_bytes", metadataBytes, np.uint8)
+        saveColumn("subject_metadata_offsets", metadataOffsets, np.int64)
+
+        metadataColumns = {}
+        for key, values in metadataValues.items():
+            rows = np.fromiter(values.keys(), dtype=np.int64)
+            columnName = "metadata_{}".format(len(metadataColumns))
+            if all(isinstance(value, numbers.Real) for value in values.values()):
+                column = np.full(numClassifications, np.nan)
+                column[rows] = list(values.values())
+                metadataColumns[key] = {"kind": "numeric", "index": len(metadataColumns)}
+            elif all(isinstance(value, str) for value in values.values()):
+                categories = sorted(set(values.values()))
+                if len(categories) > ColumnarMessageDump.maxCategories:
+                    continue
+                categoryCodes = {category: code for code, category in enumerate(categories)}
+                column = np.full(numClassifications, -1, dtype=np.int32)
+                column[rows] = [categoryCodes[value] for value in values.values()]
+                metadataColumns[key] = {
+                    "kind": "categorical",
+                    "index": len(metadataColumns),
+                    "categories": categories,
+                }
+            else:
+                continue
+            np.save(os.path.join(temporaryPath, columnName + ".npy"), column)
+
+        with open(os.path.join(temporaryPath, "meta.json"), "w") as metaFile:
+            json.dump(
+                {
+                    "version": ColumnarMessageDump.version,
+                    "numClassifications": numClassifications,
+                    "numMarks": len(marks["mark_row"]),
+                    "tasks": sorted(taskIndices, key=taskIndices.get),
+                    "metadataColumns": metadataColumns,
+                },
+                metaFile,
+            )
+
+        if os.path.exists(path):
+            oldPath = "{}.old{}".format(path, os.getpid())
+            os.rename(path, oldPath)
+            os.rename(temporaryPath, path)
+            shutil.rmtree(oldPath)
+        else:
+            os.rename(temporaryPath, path)
+
+    @staticmethod
+    def readPickleRecords(filename):
+        with open(filename, "rb") as pklfile:
+            while True:
+                try:
+                    records = pickle.load(pklfile)
+                except EOFError:
+                    break
+                for message in records if isinstance(records, list) else [records]:
+                    yield message
+
+    @staticmethod
+    def convertPickleDump(filenames, path):
+        """
+        Convert one or more pickled message dumps into a columnar dump.
+        """
+        ColumnarMessageDump.write(
+            (
+                message
+                for filename in np.atleast_1d(filenames)
+                for message in ColumnarMessageDump.readPickleRecords(filename)
+            ),
+            path,
+        )
+        return ColumnarMessageDump(path)
+
+
+class ColumnarMessageView(collections.abc.Sequence):
+    """
+    Read-only sequence of messages backed by selected rows of one or more
+    columnar dumps. Messages are materialised when they are accessed.
+    """
+
+    def __init__(self):
+        self.segments = []
+        self.segmentStarts = []
+        self.numMessages = 0
+
+    def extend(self, dump, rows):
+        if len(rows):
+            self.segments.append((dump, np.asarray(rows)))
+            self.segmentStarts.append(self.numMessages)
+            self.numMessages += len(rows)
+
+    def __len__(self):
+        return self.numMessages
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.numMessages))]
+        if index < 0:
+            index += self.numMessages
+        if not 0 <= index < self.numMessages:
+            raise IndexError("ColumnarMessageView index out of range")
+        segmentIndex = bisect.bisect_right(self.segmentStarts, index) - 1
+        dump, rows = self.segments[segmentIndex]
+        return dump.message(rows[index - self.segmentStarts[segmentIndex]])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert pickled Caesar message dumps to a columnar dump."
+    )
+    parser.add_argument("pickleFiles", nargs="+", help="Pickled message dumps")
+    parser.add_argument("outputPath", help="Output directory for the columnar dump")
+    args = parser.parse_args()
+    dump = ColumnarMessageDump.convertPickleDump(args.pickleFiles, args.outputPath)
+    print(
+        "ColumnarMessageDump: Wrote {} classifications and {} marks to {}".format(
+            len(dump), dump.meta["numMarks"], args.outputPath
+        )
+    )
@@ -0,0 +1,252 @@
+import collections
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+import uuid
+
+
+class LocalSQSError(Exception):
+    pass
+
+
+class LocalSQSClient:
+    """
+    In-memory stand-in for the subset of the boto3 SQS client API used by
+    `SQSClient`. Supports long polling, visibility timeouts and redelivery,
+    MD5 message body digests and batch send/delete/visibility requests, so
+    that ingest throughput can be measured without an AWS queue.
+
+    Pass an instance to `SQSClient` (or `SQSAggregator`) as `sqsBackend`.
+    """
+
+    maxBatchEntries = 10
+    maxPayloadBytes = 262144
+
+    def __init__(self, requestLatency=0.0):
+        """
+        Args:
+        requestLatency - Seconds added to every request to emulate the round
+        trip time to the SQS service.
+        """
+        self.requestLatency = requestLatency
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.messageAvailable = threading.Condition(self.lock)
+        self.sequence = itertools.count()
+        self.numRequests = collections.Counter()
+
+    def getQueue(self, queueUrl):
+        # Must be called with the lock held
+        if queueUrl not in self.queues:
+            self.queues[queueUrl] = dict(
+                messages={}, visible=collections.deque(), inFlight=[]
+            )
+        return self.queues[queueUrl]
+
+    def startRequest(self, requestName, entries=None):
+        if entries is not None and not 0 < len(entries) <= self.maxBatchEntries:
+            raise LocalSQSError(
+                "{}: Batch requests must contain between 1 and {} entries.".format(
+                    requestName, self.maxBatchEntries
+                )
+            )
+        with self.lock:
+            self.numRequests[requestName] += 1
+        if self.requestLatency:
+            time.sleep(self.requestLatency)
+
+    def releaseExpired(self, queue, now):
+        # Must be called with the lock held. Returns the time at which the next
+        # in-flight message becomes visible again (or None).
+        while queue["inFlight"]:
+            visibleAt, _, messageId = queue["inFlight"][0]
+            message = queue["messages"].get(messageId)
+            if message is None or message["visibleAt"] != visibleAt:
+                # Deleted, or the visibility has since been changed
+                heapq.heappop(queue["inFlight"])
+                continue
+            if visibleAt > now:
+                return visibleAt
+            heapq.heappop(queue["inFlight"])
+            message["receiptHandle"] = None
+            queue["visible"].append(messageId)
+        return None
+
+    def setVisibility(self, queue, message, visibleAt):
+        # Must be called with the lock held
+        message["visibleAt"] = visibleAt
+        heapq.heappush(
+            queue["inFlight"], (visibleAt, next(self.sequence), message["MessageId"])
+        )
+
+    def findMessage(self, queue, receiptHandle):
+        # Must be called with the lock held
+        messageId = receiptHandle.split(":", 1)[0] if receiptHandle else None
+        message = queue["messages"].get(messageId)
+        if message is None or message["receiptHandle"] != receiptHandle:
+            return None
+        return message
+
+    def addMessage(self, queue, messageBody):
+        # Must be called with the lock held
+        messageId = str(uuid.uuid4())
+        queue["messages"][messageId] = dict(
+            MessageId=messageId,
+            Body=messageBody,
+            MD5OfBody=hashlib.md5(messageBody.encode()).hexdigest(),
+            SentTimestamp=str(int(1000 * time.time())),
+            receiveCount=0,
+            receiptHandle=None,
+            visibleAt=None,
+        )
+        queue["visible"].append(messageId)
+        self.messageAvailable.notify_all()
+        return queue["messages"][messageId]
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        self.startRequest("get_queue_attributes")
+        with self.lock:
+            queue = self.getQueue(QueueUrl)
+            self.releaseExpired(queue, time.monotonic())
+            numVisible = sum(
+                messageId in queue["messages"] for messageId in queue["visible"]
+            )
+            return {
+                "Attributes": {
+                    "ApproximateNumberOfMessages": str(numVisible),
+                    "ApproximateNumberOfMessagesNotVisible": str(
+                        len(queue["messages"]) - numVisible
+                    ),
+                }
+            }
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.startRequest("send_message")
+        if len(MessageBody.encode()) > self.maxPayloadBytes:
+            raise LocalSQSError("send_message: Message body is too long.")
+        with self.lock:
+            message = self.addMessage(self.getQueue(QueueUrl), MessageBody)
+        return {"MessageId": message["MessageId"], "MD5OfMessageBody": message["MD5OfBody"]}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.startRequest("send_message_batch", Entries)
+        if sum(len(entry["MessageBody"].encode()) for entry in Entries) > self.maxPayloadBytes:
+            raise LocalSQSError("send_message_batch: Batch request is too long.")
+        successful = []
+        with self.lock:
+            queue = self.getQueue(QueueUrl)
+            for entry in Entries:
+                message = self.addMessage(queue, entry["MessageBody"])
+                successful.append(
+                    {
+                        "Id": entry["Id"],
+                        "MessageId": message["MessageId"],
+                        "MD5OfMessageBody": message["MD5OfBody"],
+                    }
+                )
+        return {"Successful": successful, "Failed": []}
+
+    def receive_message(
+        self,
+        QueueUrl,
+        MaxNumberOfMessages=1,
+        VisibilityTimeout=30,
+        WaitTimeSeconds=0,
+        **kwargs
+    ):
+        self.startRequest("receive_message")
+        deadline = time.monotonic() + WaitTimeSeconds
+        received = []
+        with self.lock:
+            while True:
+                queue = self.getQueue(QueueUrl)
+                now = time.monotonic()
+                nextVisibleAt = self.releaseExpired(queue, now)
+                while queue["visible"] and len(received) < MaxNumberOfMessages:
+                    message = queue["messages"].get(queue["visible"].popleft())
+                    if message is None:
+                        continue
+                    message["receiveCount"] += 1
+                    message["receiptHandle"] = "{}:{}".format(
+                        message["MessageId"], uuid.uuid4().hex
+                    )
+                    self.setVisibility(queue, message, now + VisibilityTimeout)
+                    received.append(
+                        {
+                            "MessageId": message["MessageId"],
+                            "ReceiptHandle": message["receiptHandle"],
+                            "MD5OfBody": message["MD5OfBody"],
+                            "Body": message["Body"],
+                            "Attributes": {
+                                "SentTimestamp": message["SentTimestamp"],
+                                "ApproximateReceiveCount": str(message["receiveCount"]),
+                            },
+                        }
+                    )
+                if received or now >= deadline:
+                    break
+                waitUntil = deadline if nextVisibleAt is None else min(deadline, nextVisibleAt)
+                self.messageAvailable.wait(timeout=max(0.0, waitUntil - now))
+        return {"Messages": received} if received else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.startRequest("delete_message")
+        with self.lock:
+            queue = self.getQueue(QueueUrl)
+            message = self.findMessage(queue, ReceiptHandle)
+            if message is None:
+                raise LocalSQSError("delete_message: The receipt handle is not valid.")
+            del queue["messages"][message["MessageId"]]
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.startRequest("delete_message_batch", Entries)
+        successful, failed = [], []
+        with self.lock:
+            queue = self.getQueue(QueueUrl)
+            for entry in Entries:
+                message = self.findMessage(queue, entry["ReceiptHandle"])
+                if message is None:
+                    failed.append(
+                        {
+                            "Id": entry["Id"],
+                            "SenderFault": True,
+                            "Code": "ReceiptHandleIsInvalid",
+                            "Message": "The receipt handle is not valid.",
+                        }
+                    )
+                    continue
+                del queue["messages"][message["MessageId"]]
+                successful.append({"Id": entry["Id"]})
+        return {"Successful": successful, "Failed": failed}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.startRequest("change_message_visibility_batch", Entries)
+        successful, failed = [], []
+        with self.lock:
+            queue = self.getQueue(QueueUrl)
+            now = time.monotonic()
+            for entry in Entries:
+                message = self.findMessage(queue, entry["ReceiptHandle"])
+                if message is None:
+                    failed.append(
+                        {
+                            "Id": entry["Id"],
+                            "SenderFault": True,
+                            "Code": "ReceiptHandleIsInvalid",
+                            "Message": "The receipt handle is not valid.",
+                        }
+                    )
+                    continue
+                self.setVisibility(queue, message, now + entry["VisibilityTimeout"])
+                successful.append({"Id": entry["Id"]})
+            self.messageAvailable.notify_all()
+        return {"Successful": successful, "Failed": failed}
+
+    def purge_queue(self, QueueUrl):
+        self.startRequest("purge_queue")
+        with self.lock:
+            self.queues.pop(QueueUrl, None)
+        return {}
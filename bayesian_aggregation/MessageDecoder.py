@@ -0,0 +1,112 @@
+import hashlib
+import importlib.util
+
+
+class MessageDecoder:
+    """
+    Decodes the JSON bodies of Caesar SQS messages.
+
+    The fastest available JSON backend is used unless one is specified.
+    Optionally, decoded messages are projected onto the fields that are
+    consumed downstream (by `SQSMessageParser`, the offline client filters and
+    the deduplication logic), which reduces the memory retained per message.
+    """
+
+    # In order of preference
+    jsonBackends = ["orjson", "ujson", "json"]
+
+    def __init__(self, jsonBackend=None, projectMessages=False, verifyBodyMD5=True):
+        """
+        Args:
+        jsonBackend - Name of the module used to decode JSON. If None, the
+        first installed module in `jsonBackends` is used.
+        projectMessages - If True, retain only the fields of each message that
+        are used by the aggregator (see `project`).
+        verifyBodyMD5 - If True, verify each message body against its MD5
+        digest before it is decoded.
+        """
+        if jsonBackend is None:
+            jsonBackend = next(
+                backend
+                for backend in MessageDecoder.jsonBackends
+                if importlib.util.find_spec(backend) is not None
+            )
+        elif importlib.util.find_spec(jsonBackend) is None:
+            error = 'The requested JSON backend "{}" is not installed.'.format(
+                jsonBackend
+            )
+            raise ModuleNotFoundError(error)
+        self.jsonBackend = jsonBackend
+        self.loads = importlib.import_module(jsonBackend).loads
+        self.projectMessages = projectMessages
+        self.verifyBodyMD5 = verifyBodyMD5
+
+    @staticmethod
+    def project(message):
+        """
+        Return a copy of `message` containing only the top-level fields and the
+        classification fields that are used by the aggregator. The user agent,
+        viewport and other classification metadata are dropped.
+        """
+        classification = message["data"]["classification"]
+        projectedMessage = {key: value for key, value in message.items() if key != "data"}
+        projectedMessage["data"] = {
+            "classification": {
+                "id": classification.get("id"),
+                "user_id": classification.get("user_id"),
+                "subject_id": classification.get("subject_id"),
+                "workflow_id": classification.get("workflow_id"),
+                "annotations": classification.get("annotations", {}),
+                "metadata": {
+                    "subject_dimensions": classification.get("metadata", {}).get(
+                        "subject_dimensions", []
+                    )
+                },
+                "subject": {
+                    "id": classification.get("subject", {}).get("id"),
+                    "metadata": classification.get("subject", {}).get("metadata", {}),
+                },
+            }
+        }
+        return projectedMessage
+
+    def decode(self, messageBody):
+        message = self.loads(messageBody)
+        if self.projectMessages:
+            message = MessageDecoder.project(message)
+        return message
+
+    def decodeMessages(self, rawMessages):
+        """
+        Decode the bodies of raw SQS messages. Returns the decoded messages,
+        their receipt handles and the receipt handles of messages that could
+        not be verified or decoded.
+        """
+        receivedMessages = []
+        receiptHandles = []
+        corruptReceiptHandles = []
+
+        # Loop over messages
+        for message in rawMessages:
+            # extract message body expect a JSON formatted string
+            # any information required to deduplicate the message should be
+            # present in the message body
+            messageBody = message["Body"]
+            # verify message body integrity
+            if (
+                self.verifyBodyMD5
+                and hashlib.md5(messageBody.encode()).hexdigest()
+                != message["MD5OfBody"]
+            ):
+                print("MD5 mismatch!")
+                corruptReceiptHandles.append(message["ReceiptHandle"])
+                continue
+            try:
+                receivedMessages.append(self.decode(messageBody))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                print("MessageDecoder: Could not decode message body.", e)
+                corruptReceiptHandles.append(message["ReceiptHandle"])
+                continue
+            receiptHandles.append(message["ReceiptHandle"])
+
+        return receivedMessages, receiptHandles, corruptReceiptHandles
@@ -0,0 +1,160 @@
+import copy
+import numbers
+import zlib
+
+import numpy as np
+
+
+class MessageFilter:
+    """
+    Declarative specification of the messages to be aggregated, shared by
+    `SQSOfflineClient` and `SQSMessageParser`.
+
+    Because the specification is data rather than an arbitrary callable, it
+    can be evaluated one message at a time (`accepts`) or as a vectorized mask
+    over the columns of a `ColumnarMessageDump` (`columnarMask`), so that
+    rejected classifications are never materialised.
+    """
+
+    def __init__(
+        self,
+        removeAnonUsers=False,
+        trainingMessagesOnly=False,
+        subjectMetadata=None,
+        numShards=1,
+        shardIndex=0,
+    ):
+        """
+        Args:
+        removeAnonUsers - If True, reject classifications by anonymous users.
+        trainingMessagesOnly - If True, only accept classifications of subjects
+        whose "origin" metadata field is "training".
+        subjectMetadata - Optional dict mapping subject metadata field names to
+        an accepted value or a list of accepted values. Subjects without the
+        field are rejected.
+        numShards - The number of shards that the subjects are partitioned
+        into. Only classifications of subjects in shard `shardIndex` are
+        accepted.
+        shardIndex - The index of the accepted shard.
+        """
+        self.removeAnonUsers = removeAnonUsers
+        self.subjectMetadata = {
+            # Values are kept as given (not as NumPy scalars) so that numeric
+            # values can be matched against numeric columns.
+            key: list(values) if isinstance(values, (list, tuple, set)) else [values]
+            for key, values in (subjectMetadata or {}).items()
+        }
+        if trainingMessagesOnly:
+            self.subjectMetadata["origin"] = ["training"]
+        self.setShard(numShards, shardIndex)
+
+    @staticmethod
+    def fromSpec(spec):
+        """
+        Return `spec` if it is a MessageFilter, or a filter on subject metadata
+        if it is a dict. Returns None for anything else (e.g. the legacy
+        callable form of `subjectMetadataFilter`).
+        """
+        if isinstance(spec, MessageFilter):
+            return spec
+        if isinstance(spec, dict):
+            return MessageFilter(subjectMetadata=spec)
+        return None
+
+    @staticmethod
+    def subjectShard(subjectId, numShards):
+        """
+        Return the shard of a subject. The shard depends only on the subject
+        ID, so it is the same in every process and on every host.
+        """
+        return zlib.crc32(str(subjectId).encode()) % numShards
+
+    def withShard(self, numShards, shardIndex):
+        """
+        Return a copy of this filter that only accepts the subjects of a shard.
+        """
+        messageFilter = copy.copy(self)
+        messageFilter.setShard(numShards, shardIndex)
+        return messageFilter
+
+    def setShard(self, numShards, shardIndex):
+        if not 0 <= shardIndex < numShards:
+            raise ValueError(
+                "Shard index {} is out of range for {} shards".format(shardIndex, numShards)
+            )
+        self.numShards = numShards
+        self.shardIndex = shardIndex
+
+    def isEmpty(self):
+        return (
+            not self.removeAnonUsers
+            and not self.subjectMetadata
+            and self.numShards == 1
+        )
+
+    def ownsSubject(self, subjectId):
+        return (
+            self.numShards == 1
+            or MessageFilter.subjectShard(subjectId, self.numShards) == self.shardIndex
+        )
+
+    def acceptsSubjectMetadata(self, metadata):
+        return all(
+            key in metadata and metadata[key] in values
+            for key, values in self.subjectMetadata.items()
+        )
+
+    def accepts(self, message):
+        if self.removeAnonUsers and message["user_id"] is None:
+            return False
+        if not self.ownsSubject(message["data"]["classification"]["subject_id"]):
+            return False
+        return self.acceptsSubjectMetadata(
+            message["data"]["classification"]["subject"]["metadata"]
+        )
+
+    def filterMessages(self, messages):
+        if self.isEmpty():
+            return messages
+        return [message for message in messages if self.accepts(message)]
+
+    def columnarMask(self, dump, rows):
+        """
+        Return a boolean mask over `rows` of the `ColumnarMessageDump` `dump`
+        selecting the accepted classifications.
+        """
+        mask = np.ones(len(rows), dtype=bool)
+        if self.removeAnonUsers:
+            mask &= dump.columns["has_user_id"][rows]
+        if self.numShards > 1:
+            subjectIds = dump.columns["subject_id"][rows]
+            uniqueSubjectIds = np.unique(subjectIds)
+            ownedSubjectIds = [
+                subjectId
+                for subjectId in uniqueSubjectIds.tolist()
+                if self.ownsSubject(subjectId)
+            ]
+            mask &= np.isin(subjectIds, ownedSubjectIds)
+        for key, values in self.subjectMetadata.items():
+            column = dump.metadataColumn(key)
+            if isinstance(column, tuple):
+                codes, categories = column
+                acceptedCodes = [
+                    code for code, category in enumerate(categories) if category in values
+                ]
+                mask &= np.isin(codes[rows], acceptedCodes)
+            elif column is not None:
+                numericValues = [
+                    value for value in values
+                    if isinstance(value, numbers.Real) and not isinstance(value, bool)
+                ]
+                mask &= np.isin(column[rows], numericValues)
+            else:
+                # The field is not stored as a column, so decode the metadata
+                # of the rows that are still selected.
+                selected = np.flatnonzero(mask)
+                mask[selected] = [
+                    key in metadata and metadata[key] in values
+                    for metadata in (dump.subjectMetadata(row) for row in rows[selected])
+                ]
+        return mask
@@ -1,6 +1,15 @@
 from .SQSClient import SQSClient, SQSOfflineClient
+from .SQSAsyncClient import SQSAsyncClient, SQSAsyncClientBridge
 from .SQSMessageParser import SQSMessageParser
+from .SQSMultiTaskMessageParser import SQSMultiTaskMessageParser
+from .SQSNumpyMessageParser import SQSNumpyMessageParser
+from .SQSNumpyMultiTaskMessageParser import SQSNumpyMultiTaskMessageParser
+from .SubjectGeometryCache import SubjectGeometryCache
+from .SubAggregatorProcess import SubAggregatorProcess
+from .SubjectShardCoordinator import SubjectShardCoordinator
 from .BBoxResultsPlotter import BBoxResultsPlotter
+from .SQSBatchPrefetcher import SQSBatchPrefetcher
+from .ClassificationIdIndex import ClassificationIdIndex
 
 import importlib
 import signal
@@ -8,6 +17,7 @@ import sys
 import os
 import time
 import pickle
+import threading
 
 if importlib.util.find_spec("crowdsourcing") is not None:
     from crowdsourcing.annotations.detection.bbox import CrowdDatasetBBox
@@ -39,6 +49,28 @@ class SQSAggregator:
         self.savePath = savePath
         self.savePrefix = savePrefix
 
+        # Optionally aggregate only the subjects in one shard of a partition of
+        # the subjects by ID, so that a workflow can be spread across several
+        # processes or hosts. In online mode every shard should consume its own
+        # queue that receives all messages (e.g. through SNS fan-out). If an
+        # exchange directory shared by the shards is provided, then worker
+        # skills are merged across the shards after every batch. Shards of the
+        # same run can share a run ID (shardRunId) that scopes the exchanged
+        # files, so that those of other runs are never merged.
+        self.numShards = kwargs.get("numShards", 1)
+        self.shardIndex = kwargs.get("shardIndex", 0)
+        self.shardCoordinator = None
+        if self.numShards > 1:
+            self.savePrefix = "{}_shard{}".format(self.savePrefix, self.shardIndex)
+            if kwargs.get("shardExchangeDir", None) is not None:
+                self.shardCoordinator = SubjectShardCoordinator(
+                    self.numShards,
+                    self.shardIndex,
+                    kwargs.get("shardExchangeDir"),
+                    exchangeTimeout=kwargs.get("shardExchangeTimeout", 300),
+                    runId=kwargs.get("shardRunId", None),
+                )
+
         self.crowdsourcing_kwargs = crowdsourcing_kwargs
 
         self.removeAnonUsers = removeAnonUsers
@@ -46,15 +78,51 @@ class SQSAggregator:
         self.offlineMode = offlineMode
         self.offlineMessageDump = offlineMessageDump
 
+        # Index of classification IDs that have already been received, shared
+        # by the client and the message parsers. If a path is provided, then
+        # the index is saved alongside the aggregation results and reloaded
+        # on restart.
+        self.classificationIdIndex = ClassificationIdIndex(
+            path=kwargs.get("classificationIdIndexPath", None)
+        )
+        # IDs of batches that have been parsed but not yet aggregated. These
+        # are omitted when the index is saved.
+        self.pendingClassificationIds = []
+        self.pendingClassificationIdsLock = threading.Lock()
+        # Serialises receives, which may run in the prefetching thread, with
+        # updates of the offline client in the aggregation thread.
+        self.sqsClientLock = threading.Lock()
+
         if self.offlineMode:
             self.sqsClient = SQSOfflineClient(
                 filename=self.offlineMessageDump,
                 sizeMetaDatumName=kwargs.get("sizeMetaDatumName", "#fwhmImagePix"),
                 trainingMessagesOnly=kwargs.get("trainingMessagesOnly", False),
                 removeAnonUsers=self.removeAnonUsers,
+                subjectMetadataFilter=kwargs.get("subjectMetadataFilter", None),
+                streamMessages=kwargs.get("streamOfflineMessages", False),
+                cursorPath=kwargs.get("offlineCursorPath", None),
+                numLoaderProcesses=kwargs.get("numLoaderProcesses", 1),
+                batchSize=kwargs.get("offlineBatchSize", None),
+                batchSizeSeed=kwargs.get("offlineBatchSizeSeed", None),
+                serveAll=kwargs.get("offlineServeAll", False),
+                numShards=self.numShards,
+                shardIndex=self.shardIndex,
+            )
+        elif kwargs.get("asyncClient", False):
+            self.sqsClient = SQSAsyncClientBridge(
+                SQSAsyncClient(
+                    queueUrl=queueUrl,
+                    classificationIdIndex=self.classificationIdIndex,
+                    **kwargs
+                )
             )
         else:
-            self.sqsClient = SQSClient(queueUrl=queueUrl, **kwargs)
+            self.sqsClient = SQSClient(
+                queueUrl=queueUrl,
+                classificationIdIndex=self.classificationIdIndex,
+                **kwargs
+            )
 
         self.saveInputAnnotations = saveInputAnnotations
         self.saveInputMessages = saveInputMessages
@@ -69,20 +137,50 @@ class SQSAggregator:
         self.subAggregators = []
         self.fullSavePrefixes = []
         self.taskLabels = kwargs.get("taskLabels", ["T0"])
+        # The subject geometry is the same for every task, so the per-task
+        # parsers share a single cache.
+        self.subjectGeometryCache = SubjectGeometryCache(
+            kwargs.get("maxCachedSubjects", 100000)
+        )
+        # The "numpy" parser engine avoids the fixed overhead of pandas, which
+        # dominates the parse time of small batches.
+        parserEngine = kwargs.get("parserEngine", "pandas")
+        if parserEngine not in ("pandas", "numpy"):
+            raise ValueError("Unknown parser engine: {}".format(parserEngine))
+        # Optionally decode each batch once and fan the marks out to the
+        # per-task parsers.
+        self.multiTaskParser = None
+        if kwargs.get("multiTaskParser", False):
+            self.multiTaskParser = (
+                SQSNumpyMultiTaskMessageParser
+                if parserEngine == "numpy"
+                else SQSMultiTaskMessageParser
+            )(
+                **dict(
+                    kwargs,
+                    taskLabels=self.taskLabels,
+                    classificationIdIndex=self.classificationIdIndex,
+                    subjectGeometryCache=self.subjectGeometryCache,
+                )
+            )
+        # Optionally run each task's sub-aggregator in its own long-lived
+        # worker process, so that the tasks of a batch are aggregated
+        # concurrently.
+        self.subAggregatorProcesses = kwargs.get("subAggregatorProcesses", False)
         try:
             for taskCounter, taskLabel in enumerate(self.taskLabels):
                 self.sqsMessageParsers.append(
-                    SQSMessageParser(taskLabel=taskLabel, **kwargs)
-                )
-                self.subAggregators.append(
-                    CrowdDatasetBBox(
-                        debug=0,
-                        learn_worker_params=True,
-                        learn_image_params=True,
-                        estimate_priors_automatically=False,
-                        computer_vision_predictor=None,
-                        naive_computer_vision=False,
-                        min_risk=self.maxRisk,
+                    self.multiTaskParser.taskParsers[taskCounter]
+                    if self.multiTaskParser is not None
+                    else (
+                        SQSNumpyMessageParser
+                        if parserEngine == "numpy"
+                        else SQSMessageParser
+                    )(
+                        taskLabel=taskLabel,
+                        classificationIdIndex=self.classificationIdIndex,
+                        subjectGeometryCache=self.subjectGeometryCache,
+                        **kwargs
                     )
                 )
                 self.fullSavePrefixes.append(
@@ -90,17 +188,23 @@ class SQSAggregator:
                         self.savePath, "{}_{}".format(self.savePrefix, taskLabel)
                     )
                 )
-                self.subAggregators[-1].fname = self.fullSavePrefixes[-1]
-
-                for k, v in self.crowdsourcing_kwargs.items():
-                    if hasattr(self.subAggregators[-1], k):
-                        setattr(self.subAggregators[-1], k, v)
-                    else:
-                        print(
-                            "Warning: No {} attribute found for CrowdDatasetBBox. Ignoring.".format(
-                                k
-                            )
+                subAggregatorKwargs = dict(
+                    fname=self.fullSavePrefixes[-1],
+                    maxRisk=self.maxRisk,
+                    crowdsourcing_kwargs=self.crowdsourcing_kwargs,
+                )
+                if self.subAggregatorProcesses:
+                    self.subAggregators.append(
+                        SubAggregatorProcess(
+                            SQSAggregator.createSubAggregator,
+                            name="SubAggregator-{}".format(taskLabel),
+                            **subAggregatorKwargs
                         )
+                    )
+                else:
+                    self.subAggregators.append(
+                        SQSAggregator.createSubAggregator(**subAggregatorKwargs)
+                    )
         except TypeError as e:
             print("TypeError raised while initialising sub-aggregators.", e)
             raise
@@ -113,6 +217,23 @@ class SQSAggregator:
         )
         self.inputMessages = [] if self.saveInputMessages else None
         self.deleteMessagesFromQueue = kwargs.get("deleteMessagesFromQueue", True)
+        # In "ack-after-aggregate" mode messages are only deleted from the queue
+        # once the batch they belong to has been aggregated and saved.
+        self.ackAfterAggregate = (
+            kwargs.get("ackAfterAggregate", False) and not self.offlineMode
+        )
+        self.aggregationVisibilityTimeout = kwargs.get(
+            "aggregationVisibilityTimeout", 600
+        )
+        self.batchReceiptHandles = []
+
+        # Optionally receive and pre-parse the next batch in a background
+        # thread while the current batch is aggregated.
+        self.prefetchBatches = kwargs.get("prefetchBatches", False)
+        self.prefetchDepth = kwargs.get("prefetchDepth", 1)
+        self.prefetcher = None
+        self.batchClassifications = None
+        self.batchClassificationIds = []
 
         self.verbose = kwargs.get("verbose", False)
         self.falseNegLossWeight = kwargs.get("falseNegLossWeight", 1)
@@ -126,32 +247,221 @@ class SQSAggregator:
         if purgeOldBBoxSetFile:
             self.purgeBBoxSetFile()
 
+    @staticmethod
+    def createSubAggregator(fname, maxRisk, crowdsourcing_kwargs):
+        subAggregator = CrowdDatasetBBox(
+            debug=0,
+            learn_worker_params=True,
+            learn_image_params=True,
+            estimate_priors_automatically=False,
+            computer_vision_predictor=None,
+            naive_computer_vision=False,
+            min_risk=maxRisk,
+        )
+        subAggregator.fname = fname
+
+        for k, v in crowdsourcing_kwargs.items():
+            if hasattr(subAggregator, k):
+                setattr(subAggregator, k, v)
+            else:
+                print(
+                    "Warning: No {} attribute found for CrowdDatasetBBox. Ignoring.".format(
+                        k
+                    )
+                )
+        return subAggregator
+
+    def collectSubAggregatorResults(self):
+        """
+        Wait for the sub-aggregator worker processes to complete the calls
+        submitted to them.
+        """
+        if self.subAggregatorProcesses:
+            for aggregator in self.subAggregators:
+                while aggregator.numPendingResults:
+                    aggregator.result()
+
+    def close(self):
+        """
+        Stop any sub-aggregator worker processes. Their sub-aggregators are
+        copied back into this process, so that results can still be saved.
+        Called when `loop` returns.
+        """
+        if self.subAggregatorProcesses:
+            for aggregator in self.subAggregators:
+                aggregator.close()
+
     def purgeBBoxSetFile(self):
         for fullSavePrefix in self.fullSavePrefixes:
             bboxSetFilePath = fullSavePrefix + ".big_bbox_set.pkl"
             if os.path.exists(bboxSetFilePath):
                 os.remove(bboxSetFilePath)
 
-    def accumulateMessages(self):
-        while len(self.allUniqueMessages) < self.messageBatchSize:
-            uniqueMessages, allMessages, messageIds = self.sqsClient.getMessages(
-                delete=self.deleteMessagesFromQueue
-            )
-            if not len(uniqueMessages):
+    def receiveBatch(self, batchMessages):
+        while len(batchMessages) < self.messageBatchSize:
+            receiveKwargs = {}
+            if not self.offlineMode:
+                # Do not receive more messages than the batch can hold, so
+                # that none consume their visibility timeout while waiting
+                # for a later batch.
+                receiveKwargs["maxMessages"] = self.messageBatchSize - len(
+                    batchMessages
+                )
+            with self.sqsClientLock:
+                uniqueMessages, allMessages, messageIds = self.sqsClient.getMessages(
+                    delete=self.deleteMessagesFromQueue and not self.ackAfterAggregate,
+                    **receiveKwargs
+                )
+            if not len(allMessages):
                 print(
                     "Aggregator: accumulateMessages: No messages extracted from queue. Accumulation stops"
                 )
-                return False
-            self.allUniqueMessages.extend(uniqueMessages)
+                return False, batchMessages
+            batchMessages.extend(uniqueMessages)
 
         if not self.offlineMode:
-            self.allUniqueMessages = self.sqsClient.deduplicate(self.allUniqueMessages)
+            batchMessages = self.sqsClient.deduplicate(batchMessages)
 
-        return True
+        return True, batchMessages
+
+    def accumulateMessages(self):
+        filled, self.allUniqueMessages = self.receiveBatch(self.allUniqueMessages)
+        if self.ackAfterAggregate:
+            self.batchReceiptHandles.extend(
+                self.sqsClient.popInFlightReceiptHandles()
+            )
+        return filled
+
+    def prefetchBatch(self):
+        _, batchMessages = self.receiveBatch([])
+        receiptHandles = []
+        if self.ackAfterAggregate:
+            receiptHandles = self.sqsClient.popInFlightReceiptHandles()
+            # Prefetched messages wait for the current batch to be aggregated
+            if self.sqsClient.heartbeat is None:
+                self.sqsClient.changeMessageVisibility(
+                    receiptHandles, self.aggregationVisibilityTimeout
+                )
+        classifications, classificationIds = self.extractBatchClassifications(
+            batchMessages
+        )
+        return batchMessages, receiptHandles, classifications, classificationIds
+
+    def extractBatchClassifications(self, batchMessages):
+        """
+        Extract the classifications for every task from a batch of messages
+        and then record the batch's classification IDs as seen.
+        """
+        if not len(batchMessages):
+            return None, []
+        if self.multiTaskParser is not None:
+            classifications = self.multiTaskParser.extractTaskClassifications(
+                batchMessages
+            )
+        else:
+            classifications = [
+                sqsMessageParser.extractClassifications(batchMessages)
+                for sqsMessageParser in self.sqsMessageParsers
+            ]
+        classificationIds = [message["classification_id"] for message in batchMessages]
+        with self.pendingClassificationIdsLock:
+            self.pendingClassificationIds.append(classificationIds)
+        self.classificationIdIndex.add(classificationIds)
+        return classifications, classificationIds
+
+    def completeBatch(self):
+        with self.pendingClassificationIdsLock:
+            if self.batchClassificationIds in self.pendingClassificationIds:
+                self.pendingClassificationIds.remove(self.batchClassificationIds)
+        self.batchClassifications = None
+        self.batchClassificationIds = []
+
+    def startPrefetching(self):
+        if self.prefetcher is None:
+            self.prefetcher = SQSBatchPrefetcher(
+                self.prefetchBatch, prefetchDepth=self.prefetchDepth
+            )
+            self.prefetcher.start()
+
+    def stopPrefetching(self):
+        if self.prefetcher is not None:
+            for _, receiptHandles, _, _ in self.prefetcher.stop():
+                if self.ackAfterAggregate:
+                    self.sqsClient.changeMessageVisibility(receiptHandles, 0)
+            self.prefetcher = None
+
+    def takePrefetchedBatch(self):
+        (
+            self.allUniqueMessages,
+            self.batchReceiptHandles,
+            self.batchClassifications,
+            self.batchClassificationIds,
+        ) = self.prefetcher.getBatch()
+        return len(self.allUniqueMessages) > 0
 
     def aggregate(self):
-        if not self.accumulateMessages() and len(self.allUniqueMessages) == 0:
+        # Batches whose classifications are all rejected by the parsers (e.g.
+        # because they were seen before or are filtered out) are discarded and
+        # the next batch is aggregated instead.
+        while True:
+            aggregated = self.aggregateBatch()
+            if aggregated is not None:
+                return aggregated
+
+    def discardBatch(self):
+        """
+        Discard the current batch without aggregating it. In
+        "ack-after-aggregate" mode its messages are deleted from the queue,
+        since they will never be aggregated.
+        """
+        print(
+            "Aggregator: No new classifications in batch of {} messages. Batch discarded.".format(
+                len(self.allUniqueMessages)
+            )
+        )
+        if self.ackAfterAggregate:
+            self.sqsClient.deleteMessages(self.batchReceiptHandles)
+            self.batchReceiptHandles = []
+        self.allUniqueMessages = []
+        self.completeBatch()
+
+    def deleteDuplicateMessages(self):
+        """
+        In "ack-after-aggregate" mode, delete the messages received for a
+        batch that has no new messages. They are all duplicates of messages
+        that have already been aggregated.
+        """
+        if self.ackAfterAggregate and self.batchReceiptHandles:
+            print(
+                "Aggregator: Deleting {} duplicate messages.".format(
+                    len(self.batchReceiptHandles)
+                )
+            )
+            self.sqsClient.deleteMessages(self.batchReceiptHandles)
+            self.batchReceiptHandles = []
+
+    def releaseBatch(self):
+        """
+        In "ack-after-aggregate" mode, make the messages of a batch that will
+        not be aggregated visible again, so that they are redelivered.
+        """
+        if self.ackAfterAggregate and self.batchReceiptHandles:
+            self.sqsClient.changeMessageVisibility(self.batchReceiptHandles, 0)
+            self.batchReceiptHandles = []
+
+    def aggregateBatch(self):
+        """
+        Aggregate the next batch. Returns True if the batch was aggregated,
+        False if no messages are available and None if the batch was
+        discarded.
+        """
+        if self.prefetcher is not None:
+            if not self.takePrefetchedBatch():
+                self.deleteDuplicateMessages()
+                return False
+        elif not self.accumulateMessages() and len(self.allUniqueMessages) == 0:
             # If no messages are available for processing
+            self.deleteDuplicateMessages()
             return False
         else:
             print(
@@ -160,13 +470,25 @@ class SQSAggregator:
                 " messages.",
             )
 
-        for taskLabel, aggregator, sqsMessageParser in zip(
-            self.taskLabels, self.subAggregators, self.sqsMessageParsers
+        if self.batchClassifications is None:
+            (
+                self.batchClassifications,
+                self.batchClassificationIds,
+            ) = self.extractBatchClassifications(self.allUniqueMessages)
+        if self.batchClassifications is None:
+            self.discardBatch()
+            return None
+
+        for taskLabel, aggregator, sqsMessageParser, classifications in zip(
+            self.taskLabels,
+            self.subAggregators,
+            self.sqsMessageParsers,
+            self.batchClassifications,
         ):
-            if not sqsMessageParser.processMessages(
-                uniqueMessages=self.allUniqueMessages
-            ):
-                return False
+            if not sqsMessageParser.processExtractedClassifications(classifications):
+                self.collectSubAggregatorResults()
+                self.discardBatch()
+                return None
 
             if self.saveInputAnnotations:
                 self.inputAnnotations[taskLabel].extend(
@@ -174,13 +496,15 @@ class SQSAggregator:
                 )
 
             aggInput = sqsMessageParser.getAggregatorInputData()
+            if self.shardCoordinator is not None:
+                self.shardCoordinator.countAnnotations(taskLabel, aggInput["annos"])
             print(
                 "Agg input for batch: Num annos = {}, Num images = {}".format(
                     len(aggInput["annos"]), len(aggInput["images"])
                 ),
                 flush=True,
             )
-            aggregator.load(
+            loadKwargs = dict(
                 data=aggInput,
                 overwrite_workers=False,
                 load_workers=False,
@@ -188,19 +512,83 @@ class SQSAggregator:
                 load_dataset=False,
                 clear_previous_image_annos=False,
             )
-            aggregator.get_big_bbox_set()
-            print("NOTE: Ignoring data from finished subjects")
-            aggregator.estimate_parameters(
-                avoid_if_finished=True, max_iters=25, refine=True
-            )
+            estimateKwargs = dict(avoid_if_finished=True, max_iters=25, refine=True)
+            if self.subAggregatorProcesses:
+                # The worker process aggregates this task while the remaining
+                # tasks are parsed and submitted.
+                aggregator.submit("load", **loadKwargs)
+                aggregator.submit("get_big_bbox_set")
+                print("NOTE: Ignoring data from finished subjects")
+                aggregator.submit("estimate_parameters", **estimateKwargs)
+            else:
+                aggregator.load(**loadKwargs)
+                aggregator.get_big_bbox_set()
+                if self.ackAfterAggregate and self.sqsClient.heartbeat is None:
+                    self.sqsClient.changeMessageVisibility(
+                        self.batchReceiptHandles, self.aggregationVisibilityTimeout
+                    )
+                print("NOTE: Ignoring data from finished subjects")
+                aggregator.estimate_parameters(**estimateKwargs)
             sqsMessageParser.clearProcessedClassifications()
 
+        if self.subAggregatorProcesses:
+            if self.ackAfterAggregate and self.sqsClient.heartbeat is None:
+                self.sqsClient.changeMessageVisibility(
+                    self.batchReceiptHandles, self.aggregationVisibilityTimeout
+                )
+            self.collectSubAggregatorResults()
+
         if self.saveInputMessages:
             self.inputMessages.extend(self.allUniqueMessages)
         self.allUniqueMessages = []
+        self.completeBatch()
         return True
 
+    def getShardWorkers(self):
+        return {
+            taskLabel: aggregator.save(
+                fname=None,
+                save_dataset=False,
+                save_images=False,
+                save_workers=True,
+                save_annos=False,
+                save_combined_labels=False,
+            )["workers"]
+            for taskLabel, aggregator in zip(self.taskLabels, self.subAggregators)
+        }
+
+    def exchangeShardWorkers(self, roundIndex):
+        """
+        Merge the skills of this shard's workers with those learned by the
+        other shards.
+        """
+        if self.shardCoordinator is None:
+            return
+        mergedTaskWorkers = self.shardCoordinator.exchange(
+            roundIndex, self.getShardWorkers()
+        )
+        for taskLabel, aggregator in zip(self.taskLabels, self.subAggregators):
+            # Only workers already known to this shard are updated, and they
+            # keep their annotations.
+            aggregator.load(
+                data=dict(workers=mergedTaskWorkers[taskLabel], images={}, annos=[]),
+                overwrite_workers=False,
+                load_workers=True,
+                load_images=False,
+                load_dataset=False,
+                clear_previous_image_annos=False,
+            )
+
+    def idleShard(self, roundIndex):
+        """
+        Let the other shards merge skills without waiting for this shard while
+        it has no batch to aggregate.
+        """
+        if self.shardCoordinator is not None:
+            self.shardCoordinator.idle(roundIndex)
+
     def checkNumFinished(self):
+        finishedSubjectIds = None
         for taskLabel, aggregator in zip(self.taskLabels, self.subAggregators):
             image_id_to_finished = aggregator.check_finished_annotations(
                 set_finished=True,
@@ -208,6 +596,14 @@ class SQSAggregator:
                 loss_fn=self.falseNegLossWeight,
                 loss_fp=self.falsePosLossWeight,
             )
+            taskFinishedSubjectIds = {
+                int(image_id) for image_id, finished in image_id_to_finished.items() if finished
+            }
+            finishedSubjectIds = (
+                taskFinishedSubjectIds
+                if finishedSubjectIds is None
+                else finishedSubjectIds & taskFinishedSubjectIds
+            )
             num_finished = sum(image_id_to_finished.values())
             if len(image_id_to_finished) > 0:
                 print(
@@ -218,6 +614,9 @@ class SQSAggregator:
                         100.0 * float(num_finished) / len(image_id_to_finished),
                     )
                 )
+        # Subjects that are finished for every task need no cached geometry.
+        if finishedSubjectIds:
+            self.subjectGeometryCache.retire(finishedSubjectIds)
 
     def save(self):
         for aggregator, fullSavePrefix in zip(
@@ -235,6 +634,14 @@ class SQSAggregator:
         if self.saveInputMessages:
             self.dumpInputMessages()
 
+        with self.pendingClassificationIdsLock:
+            pendingClassificationIds = [
+                classificationId
+                for classificationIds in self.pendingClassificationIds
+                for classificationId in classificationIds
+            ]
+        self.classificationIdIndex.save(excludeIds=pendingClassificationIds)
+
     def dumpInputMessages(self):
         inputMessageFileName = "{}_inputMessages.pkl".format(self.savePrefix)
         with open(inputMessageFileName, mode="wb") as inputMessageFile:
@@ -270,59 +677,94 @@ class SQSAggregator:
     ):
         retries = 0
         n_loop = 0
-        while self.maxLoops is None or  n_loop < self.maxLoops:
-            if self.maxLoops is None:
-                print(f"Processing batch {n_loop}...")
-            else:
-                print(f"Processing batch {n_loop} of {self.maxLoops}...")
+        if self.prefetchBatches:
+            self.startPrefetching()
+        try:
+            while self.maxLoops is None or  n_loop < self.maxLoops:
+                if self.maxLoops is None:
+                    print(f"Processing batch {n_loop}...")
+                else:
+                    print(f"Processing batch {n_loop} of {self.maxLoops}...")
             
-            if self.aggregate():
-                if plotInterrimResults:
-                    for taskLabel, aggregator in zip(
-                        self.taskLabels, self.subAggregators
-                    ):
-                        BBoxResultsPlotter.plotUserData(
-                            aggregator,
-                            interrimPlotDir,
-                            "userSkills_{}_{}".format(taskLabel, n_loop),
+                aggregated = self.aggregate()
+
+                if aggregated:
+                    if self.ackAfterAggregate:
+                        self.save()
+                        self.sqsClient.deleteMessages(self.batchReceiptHandles)
+                        self.batchReceiptHandles = []
+                    if not self.offlineMode and self.sqsClient.heartbeat is not None:
+                        print(
+                            "Aggregator: Visibility of in-flight messages extended {} times during batch {}".format(
+                                self.sqsClient.heartbeat.popExtensionCount(), n_loop
+                            )
                         )
-                        # with open(os.path.join(self.savePath, "userSkillData", "userSkills_{}_{}.pkl".format(taskLabel, n_loop)), mode="wb") as skillFile:
-                        #     pickle.dump(obj=aggregator.workers, file=skillFile)
-                if verbose:
-                    self.checkNumFinished()
-                    if self.postIterateCallback is not None:
-                        self.postIterateCallback(
-                            {
-                                taskLabel: {
-                                    "data": subAgg.save(fname=None),
-                                    "finished_id_map": subAgg.check_finished_annotations(
-                                        set_finished=True
-                                    ),
+                    if plotInterrimResults:
+                        for taskLabel, aggregator in zip(
+                            self.taskLabels, self.subAggregators
+                        ):
+                            BBoxResultsPlotter.plotUserData(
+                                aggregator,
+                                interrimPlotDir,
+                                "userSkills_{}_{}".format(taskLabel, n_loop),
+                            )
+                            # with open(os.path.join(self.savePath, "userSkillData", "userSkills_{}_{}.pkl".format(taskLabel, n_loop)), mode="wb") as skillFile:
+                            #     pickle.dump(obj=aggregator.workers, file=skillFile)
+                    if verbose:
+                        self.checkNumFinished()
+                        if self.postIterateCallback is not None:
+                            self.postIterateCallback(
+                                {
+                                    taskLabel: {
+                                        "data": subAgg.save(fname=None),
+                                        "finished_id_map": subAgg.check_finished_annotations(
+                                            set_finished=True
+                                        ),
+                                    }
+                                    for taskLabel, subAgg in zip(
+                                        self.taskLabels, self.subAggregators
+                                    )
                                 }
-                                for taskLabel, subAgg in zip(
-                                    self.taskLabels, self.subAggregators
-                                )
-                            }
-                        )
-                if self.saveIntermittently and not (n_loop % 10):
-                    self.save()
-                self.purgeBBoxSetFile()
-                n_loop += 1
-            elif not stopOnExhaustion:
-                print("No messages received. Waiting...")
-                if self.offlineMode:
-                    time.sleep(60)
-                    self.sqsClient.update()
-                continue
-            elif retries < 3:
-                print(
-                    "No messages received after {} retries. Retrying...".format(retries)
-                )
-                retries += 1
-                self.checkNumFinished()
-            else:
-                print(
-                    "No messages received after {} retries. Stopping.".format(retries)
-                )
-                self.checkNumFinished()
-                break
+                            )
+                    if (
+                        self.saveIntermittently
+                        and not self.ackAfterAggregate
+                        and not (n_loop % 10)
+                    ):
+                        self.save()
+                    self.purgeBBoxSetFile()
+                    self.exchangeShardWorkers(n_loop)
+                    n_loop += 1
+                elif not stopOnExhaustion:
+                    print("No messages received. Waiting...")
+                    self.idleShard(n_loop - 1)
+                    if self.offlineMode:
+                        time.sleep(60)
+                        with self.sqsClientLock:
+                            self.sqsClient.update()
+                    continue
+                elif retries < 3:
+                    print(
+                        "No messages received after {} retries. Retrying...".format(retries)
+                    )
+                    retries += 1
+                    self.idleShard(n_loop - 1)
+                    self.checkNumFinished()
+                else:
+                    print(
+                        "No messages received after {} retries. Stopping.".format(retries)
+                    )
+                    self.checkNumFinished()
+                    break
+
+            if self.shardCoordinator is not None:
+                self.shardCoordinator.finish(n_loop, self.getShardWorkers())
+        finally:
+            # Also on errors and interrupts, stop prefetching, make any
+            # unacknowledged messages visible again and stop the client's
+            # threads and the sub-aggregator worker processes.
+            self.stopPrefetching()
+            self.releaseBatch()
+            if not self.offlineMode:
+                self.sqsClient.close()
+            self.close()
@@ -0,0 +1,288 @@
+import asyncio
+import functools
+import importlib.util
+import json
+import threading
+
+from .MessageDecoder import MessageDecoder
+from .SQSClient import SQSClient
+
+
+class SQSAsyncClient:
+    """
+    asyncio counterpart of `SQSClient`. The `getMessages`, `putMessages` and
+    `deduplicate` coroutines return the same values as the corresponding
+    `SQSClient` methods.
+
+    Unless an `sqsBackend` is supplied, all instances running on the same event
+    loop share a single aiobotocore client, and therefore a single connection
+    pool, so that one event loop can poll many queues. Synchronous backends
+    (e.g. `LocalSQSClient`) are called in the event loop's default executor.
+    """
+
+    sharedClients = {}
+
+    def __init__(self, queueUrl, **kwargs):
+        self.sqs = kwargs.get("sqsBackend", None)
+        self.queueUrl = queueUrl
+        self.maxPoolConnections = kwargs.get("maxPoolConnections", 50)
+        self.maxDeleteRetries = kwargs.get("maxDeleteRetries", 3)
+        self.numFailedAcks = 0
+        self.maxSendRetries = kwargs.get("maxSendRetries", 3)
+        self.retryBaseDelay = kwargs.get("retryBaseDelay", 0.1)
+        self.maxRetryDelay = kwargs.get("maxRetryDelay", 5.0)
+        self.maxConcurrentSends = kwargs.get("maxConcurrentSends", 8)
+        self.classificationIdIndex = kwargs.get("classificationIdIndex", None)
+        self.messageDecoder = MessageDecoder(
+            jsonBackend=kwargs.get("jsonBackend", None),
+            projectMessages=kwargs.get("projectMessages", False),
+            verifyBodyMD5=kwargs.get("verifyBodyMD5", True),
+        )
+        self.ackAfterAggregate = kwargs.get("ackAfterAggregate", False)
+        self.inFlightReceiptHandles = []
+        self.visibilityTimeout = kwargs.get("visibilityTimeout", 40)
+        self.waitTimeSeconds = 20
+
+    @classmethod
+    async def getSharedClient(cls, maxPoolConnections):
+        loop = asyncio.get_running_loop()
+        if loop not in cls.sharedClients:
+            if importlib.util.find_spec("aiobotocore") is None:
+                error = 'SQSAsyncClient requires the "aiobotocore" module unless an sqsBackend is supplied.'
+                raise ModuleNotFoundError(error)
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import get_session
+
+            clientContext = get_session().create_client(
+                "sqs", config=AioConfig(max_pool_connections=maxPoolConnections)
+            )
+            cls.sharedClients[loop] = (clientContext, await clientContext.__aenter__())
+        return cls.sharedClients[loop][1]
+
+    @classmethod
+    async def closeSharedClient(cls):
+        clientContext, _ = cls.sharedClients.pop(asyncio.get_running_loop(), (None, None))
+        if clientContext is not None:
+            await clientContext.__aexit__(None, None, None)
+
+    async def call(self, operationName, **kwargs):
+        if self.sqs is None:
+            self.sqs = await SQSAsyncClient.getSharedClient(self.maxPoolConnections)
+        operation = getattr(self.sqs, operationName)
+        if asyncio.iscoroutinefunction(operation):
+            return await operation(**kwargs)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(operation, **kwargs)
+        )
+
+    async def getMessages(self, delete=True, maxMessages=None):
+        response = await self.call(
+            "receive_message",
+            QueueUrl=self.queueUrl,
+            AttributeNames=["SentTimestamp", "MessageDeduplicationId"],
+            MaxNumberOfMessages=SQSClient.receiveSize(maxMessages),
+            MessageAttributeNames=["All"],
+            VisibilityTimeout=self.visibilityTimeout,
+            WaitTimeSeconds=self.waitTimeSeconds,
+        )
+        receivedMessages, receiptHandles, _ = self.messageDecoder.decodeMessages(
+            response.get("Messages", [])
+        )
+        receivedMessageIds = [message["classification_id"] for message in receivedMessages]
+
+        if delete:
+            await self.deleteMessages(receiptHandles)
+        elif self.ackAfterAggregate:
+            self.inFlightReceiptHandles.extend(receiptHandles)
+
+        messages = await self.deduplicate(receivedMessages)
+        return messages, receivedMessages, receivedMessageIds
+
+    async def deduplicate(self, messageList):
+        return SQSClient.deduplicateMessages(messageList, self.classificationIdIndex)
+
+    async def callBatch(self, operationName, entries, maxRetries, **kwargs):
+        """
+        Issue a batch request for `entries` (a dict mapping entry IDs to entry
+        parameters), retrying entries that fail on the service side with an
+        exponential backoff. Returns the number of successful entries and the
+        IDs of failed entries.
+        """
+        numSuccessful = 0
+        failedIds = []
+        for attempt in range(maxRetries + 1):
+            if attempt:
+                await asyncio.sleep(
+                    SQSClient.retryDelay(attempt, self.retryBaseDelay, self.maxRetryDelay)
+                )
+            try:
+                response = await self.call(
+                    operationName,
+                    QueueUrl=self.queueUrl,
+                    Entries=[dict(Id=entryId, **entry) for entryId, entry in entries.items()],
+                    **kwargs
+                )
+            except Exception as e:
+                print("SQSAsyncClient: {} failed.".format(operationName), e)
+                continue
+            numSuccessful += len(response.get("Successful", []))
+            failed = response.get("Failed", [])
+            failedIds.extend(
+                failure["Id"] for failure in failed if failure.get("SenderFault", False)
+            )
+            entries = {
+                failure["Id"]: entries[failure["Id"]]
+                for failure in failed
+                if not failure.get("SenderFault", False)
+            }
+            if not entries:
+                break
+        return numSuccessful, failedIds + list(entries)
+
+    async def deleteMessages(self, receiptHandles):
+        results = await asyncio.gather(
+            *[
+                self.callBatch(
+                    "delete_message_batch",
+                    {
+                        str(entryId): dict(ReceiptHandle=receiptHandle)
+                        for entryId, receiptHandle in enumerate(
+                            receiptHandles[batchStart : batchStart + SQSClient.maxBatchEntries]
+                        )
+                    },
+                    self.maxDeleteRetries,
+                )
+                for batchStart in range(0, len(receiptHandles), SQSClient.maxBatchEntries)
+            ]
+        )
+        numFailed = sum(len(failedIds) for _, failedIds in results)
+        self.numFailedAcks += numFailed
+        return numFailed
+
+    async def changeMessageVisibility(self, receiptHandles, visibilityTimeout):
+        results = await asyncio.gather(
+            *[
+                self.callBatch(
+                    "change_message_visibility_batch",
+                    {
+                        str(entryId): dict(
+                            ReceiptHandle=receiptHandle,
+                            VisibilityTimeout=visibilityTimeout,
+                        )
+                        for entryId, receiptHandle in enumerate(
+                            receiptHandles[batchStart : batchStart + SQSClient.maxBatchEntries]
+                        )
+                    },
+                    0,
+                )
+                for batchStart in range(0, len(receiptHandles), SQSClient.maxBatchEntries)
+            ]
+        )
+        return sum(len(failedIds) for _, failedIds in results)
+
+    def popInFlightReceiptHandles(self):
+        receiptHandles = self.inFlightReceiptHandles
+        self.inFlightReceiptHandles = []
+        return receiptHandles
+
+    async def close(self):
+        if self.inFlightReceiptHandles:
+            await self.changeMessageVisibility(self.popInFlightReceiptHandles(), 0)
+
+    async def putMessages(self, messages, purge=False):
+        if purge:
+            await self.call("purge_queue", QueueUrl=self.queueUrl)
+
+        messageBodies = [
+            json.dumps(message) for message in messages if type(message) == dict
+        ]
+        batches, oversizeBodies = SQSClient.packMessageBatches(messageBodies)
+        sendLimit = asyncio.Semaphore(self.maxConcurrentSends)
+
+        async def sendMessageBatch(batch):
+            async with sendLimit:
+                entries = {
+                    str(entryId): dict(MessageBody=messageBody)
+                    for entryId, messageBody in enumerate(batch)
+                }
+                numSent, failedIds = await self.callBatch(
+                    "send_message_batch", entries, self.maxSendRetries
+                )
+                return numSent, [batch[int(entryId)] for entryId in failedIds]
+
+        batchResults = await asyncio.gather(
+            *[sendMessageBatch(batch) for batch in batches]
+        )
+
+        numSent = sum(batchNumSent for batchNumSent, _ in batchResults)
+        failedBodies = oversizeBodies + [
+            messageBody
+            for _, batchFailedBodies in batchResults
+            for messageBody in batchFailedBodies
+        ]
+        print(
+            'SQSAsyncClient posted {} messages to "{}"" ({} failed)'.format(
+                numSent, self.queueUrl, len(failedBodies)
+            )
+        )
+        return {
+            "sent": numSent,
+            "failed": len(failedBodies),
+            "failedMessages": [json.loads(messageBody) for messageBody in failedBodies],
+        }
+
+
+class SQSAsyncClientBridge:
+    """
+    Synchronous interface to an `SQSAsyncClient` that allows it to be used by
+    `SQSAggregator`. Coroutines are run on an event loop in a background
+    thread that is shared by all bridges in the process.
+    """
+
+    loop = None
+    loopLock = threading.Lock()
+
+    def __init__(self, asyncClient):
+        self.asyncClient = asyncClient
+        # Visibility heartbeats are not supported by the asynchronous client
+        self.heartbeat = None
+
+    @classmethod
+    def getLoop(cls):
+        with cls.loopLock:
+            if cls.loop is None:
+                cls.loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=cls.loop.run_forever, name="SQSAsyncClientLoop", daemon=True
+                ).start()
+        return cls.loop
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(
+            coroutine, SQSAsyncClientBridge.getLoop()
+        ).result()
+
+    def getMessages(self, delete=True, maxMessages=None):
+        return self.run(
+            self.asyncClient.getMessages(delete=delete, maxMessages=maxMessages)
+        )
+
+    def putMessages(self, messages, purge=False):
+        return self.run(self.asyncClient.putMessages(messages, purge=purge))
+
+    def deduplicate(self, messageList):
+        return self.run(self.asyncClient.deduplicate(messageList))
+
+    def deleteMessages(self, receiptHandles):
+        return self.run(self.asyncClient.deleteMessages(receiptHandles))
+
+    def changeMessageVisibility(self, receiptHandles, visibilityTimeout):
+        return self.run(
+            self.asyncClient.changeMessageVisibility(receiptHandles, visibilityTimeout)
+        )
+
+    def popInFlightReceiptHandles(self):
+        return self.asyncClient.popInFlightReceiptHandles()
+
+    def close(self):
+        self.run(self.asyncClient.close())
@@ -0,0 +1,74 @@
+import queue
+import threading
+
+
+class SQSBatchPrefetcher:
+    """
+    Runs a batch-producing callable in a background thread so that the next
+    batch is received and pre-parsed while the current one is aggregated.
+    """
+
+    def __init__(self, fetchBatch, prefetchDepth=1):
+        """
+        Args:
+        fetchBatch - Callable returning the next batch.
+        prefetchDepth - The maximum number of fetched batches that may wait to
+        be consumed. The fetching thread blocks while this many are waiting.
+        """
+        self.fetchBatch = fetchBatch
+        self.batches = queue.Queue(maxsize=prefetchDepth)
+        self.stopEvent = threading.Event()
+        self.thread = None
+        self.unqueuedBatches = []
+
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="SQSBatchPrefetcher", daemon=True
+        )
+        self.thread.start()
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                batch = self.fetchBatch()
+            except Exception as e:
+                # Hand the exception to the consumer so that it is raised in
+                # the aggregation thread.
+                batch = e
+            while True:
+                if self.stopEvent.is_set():
+                    self.unqueuedBatches.append(batch)
+                    return
+                try:
+                    self.batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def getBatch(self):
+        batch = self.batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def stop(self):
+        """
+        Stop prefetching, waiting for any in-progress fetch to complete, and
+        return the batches that were fetched but not consumed.
+        """
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        remainingBatches = []
+        while True:
+            try:
+                remainingBatches.append(self.batches.get_nowait())
+            except queue.Empty:
+                break
+        remainingBatches.extend(self.unqueuedBatches)
+        self.unqueuedBatches = []
+        return [
+            batch for batch in remainingBatches if not isinstance(batch, Exception)
+        ]
@@ -1,28 +1,79 @@
 import os
-import hashlib
 import boto3
 import json
+import itertools
 import pickle
+import random
+import time
+import concurrent.futures
 import numpy as np
 import astropy.io.fits as fitsio
 
-class UniqueMessage:
-    def __init__(self, message):
-        self.classification_id = int(message["classification_id"])
-        self.message = message
+from .ClassificationIdIndex import ClassificationIdIndex
+from .ColumnarMessageDump import ColumnarMessageDump, ColumnarMessageView
+from .MessageDecoder import MessageDecoder
+from .MessageFilter import MessageFilter
+from .SQSPollerPool import SQSPollerPool
+from .SQSVisibilityHeartbeat import SQSVisibilityHeartbeat
 
-    def __eq__(self, other):
-        return self.classification_id == other.classification_id
-
-    def __hash__(self):
-        return hash(self.classification_id)
+class SQSClient:
 
+    # SQS accepts at most 10 entries per batch request
+    maxBatchEntries = 10
+    # ...and at most 256 KiB of message payload per (batch) request
+    maxBatchPayloadBytes = 262144
 
-class SQSClient:
     def __init__(self, queueUrl, **kwargs):
-        self.sqs = boto3.client("sqs")
+        # Any object implementing the boto3 SQS client API may be supplied,
+        # e.g. a `LocalSQSClient` for offline testing.
+        self.sqs = kwargs.get("sqsBackend", None)
+        if self.sqs is None:
+            self.sqs = boto3.client("sqs")
         self.queueUrl = queueUrl
         self.subscribers = []
+        self.maxDeleteRetries = kwargs.get("maxDeleteRetries", 3)
+        self.numFailedAcks = 0
+        # Retries of failed batch entries are delayed by an exponential
+        # backoff, so that they are not used up at once against a throttled
+        # endpoint.
+        self.retryBaseDelay = kwargs.get("retryBaseDelay", 0.1)
+        self.maxRetryDelay = kwargs.get("maxRetryDelay", 5.0)
+        self.maxSendRetries = kwargs.get("maxSendRetries", 3)
+        self.numSenderThreads = kwargs.get("numSenderThreads", 8)
+        # Optional index of classification IDs that have already been
+        # processed. Messages with IDs in the index are discarded.
+        self.classificationIdIndex = kwargs.get("classificationIdIndex", None)
+        self.messageDecoder = MessageDecoder(
+            jsonBackend=kwargs.get("jsonBackend", None),
+            projectMessages=kwargs.get("projectMessages", False),
+            verifyBodyMD5=kwargs.get("verifyBodyMD5", True),
+        )
+        # In "ack-after-aggregate" mode, messages that are not deleted on
+        # receipt are tracked until they are acknowledged or released.
+        self.ackAfterAggregate = kwargs.get("ackAfterAggregate", False)
+        self.inFlightReceiptHandles = []
+        self.visibilityTimeout = kwargs.get("visibilityTimeout", 40)
+        # Optionally keep extending the visibility of received messages until
+        # they are deleted or released.
+        self.heartbeat = None
+        if kwargs.get("visibilityHeartbeat", False):
+            self.heartbeat = SQSVisibilityHeartbeat(
+                self.changeMessageVisibility,
+                visibilityTimeout=self.visibilityTimeout,
+                interval=kwargs.get("heartbeatInterval", None),
+            )
+            self.heartbeat.start()
+        # Optionally receive using a pool of concurrent long-polling threads
+        self.waitTimeSeconds = 20
+        self.pollerPool = None
+        if kwargs.get("numPollers", 0) > 0:
+            self.pollerPool = SQSPollerPool(
+                self.receiveMessages,
+                numPollers=kwargs["numPollers"],
+                bufferSize=kwargs.get("receiveBufferSize", 200),
+                receiveSize=SQSClient.maxBatchEntries,
+            )
+            self.pollerPool.start()
         if kwargs.get("verbose", False):
             print(
                 "SQS Queue Attributes",
@@ -31,172 +82,722 @@ class SQSClient:
                 ),
             )
 
-    def getMessages(self, delete=True):
+    def receiveMessages(self, maxMessages=None):
         response = self.sqs.receive_message(
             QueueUrl=self.queueUrl,
             AttributeNames=["SentTimestamp", "MessageDeduplicationId"],
-            MaxNumberOfMessages=10,  # Allow up to 10 messages to be received
+            # Allow up to 10 messages to be received
+            MaxNumberOfMessages=SQSClient.receiveSize(maxMessages),
             MessageAttributeNames=["All"],
-            # Allows the message to be retrieved again after 40s
-            VisibilityTimeout=40,
+            # Allows the message to be retrieved again after the visibility
+            # timeout (default 40s)
+            VisibilityTimeout=self.visibilityTimeout,
             # Wait at most 20 seconds for an extract enables long polling
-            WaitTimeSeconds=20,
+            WaitTimeSeconds=self.waitTimeSeconds,
         )
+        messages = response.get("Messages", [])
+        if self.heartbeat is not None:
+            self.heartbeat.track([message["ReceiptHandle"] for message in messages])
+        return messages
 
-        receivedMessageIds = []
-        receivedMessages = []
-        uniqueMessages = set()
-
-        # Loop over messages
-        if "Messages" in response:
-            for message in response["Messages"]:
-                # extract message body expect a JSON formatted string
-                # any information required to deduplicate the message should be
-                # present in the message body
-                messageBody = message["Body"]
-                # verify message body integrity
-                messageBodyMd5 = hashlib.md5(messageBody.encode()).hexdigest()
-
-                if messageBodyMd5 == message["MD5OfBody"]:
-                    receivedMessages.append(json.loads(messageBody))
-                    receivedMessageIds.append(receivedMessages[-1]["classification_id"])
-                    uniqueMessage = UniqueMessage(receivedMessages[-1])
-
-                    uniqueMessages.add(uniqueMessage)
-
-                    if delete:
-                        self.sqs.delete_message(
-                            QueueUrl=self.queueUrl,
-                            ReceiptHandle=message["ReceiptHandle"],
-                        )
-                else:
-                    print("MD5 mismatch!")
+    @staticmethod
+    def receiveSize(maxMessages):
+        if maxMessages is None:
+            return SQSClient.maxBatchEntries
+        return max(1, min(maxMessages, SQSClient.maxBatchEntries))
+
+    def getMessages(self, delete=True, maxMessages=None):
+        """
+        Args:
+        delete - If True, delete the received messages from the queue.
+        maxMessages - The maximum number of messages to return (at most
+        `maxBatchEntries`).
+        """
+        if self.pollerPool is not None:
+            rawMessages = self.pollerPool.drain(
+                maxMessages=SQSClient.receiveSize(maxMessages),
+                timeout=self.waitTimeSeconds,
+            )
+        else:
+            rawMessages = self.receiveMessages(maxMessages=maxMessages)
+
+        (
+            receivedMessages,
+            receiptHandles,
+            abandonedReceiptHandles,
+        ) = self.messageDecoder.decodeMessages(rawMessages)
+        receivedMessageIds = [message["classification_id"] for message in receivedMessages]
+
+        if delete:
+            self.deleteMessages(receiptHandles)
+        elif self.ackAfterAggregate:
+            self.inFlightReceiptHandles.extend(receiptHandles)
+        else:
+            abandonedReceiptHandles.extend(receiptHandles)
 
-        messages = [m.message for m in uniqueMessages]
+        if self.heartbeat is not None:
+            self.heartbeat.release(abandonedReceiptHandles)
+
+        messages = self.deduplicate(receivedMessages)
         return messages, receivedMessages, receivedMessageIds
 
+    @staticmethod
+    def retryDelay(attempt, baseDelay, maxDelay):
+        """
+        Return the delay in seconds before retry number `attempt` (from 1) of
+        a batch request. The delay is drawn uniformly up to an exponentially
+        growing bound ("full jitter"), so that concurrent clients spread out
+        their retries.
+        """
+        return random.uniform(0, min(maxDelay, baseDelay * 2 ** (attempt - 1)))
+
+    def deleteMessages(self, receiptHandles):
+        """
+        Delete messages from the queue using `delete_message_batch` requests of
+        up to 10 entries. Entries that fail are retried up to
+        `maxDeleteRetries` times, with an exponential backoff. Returns the number of messages that could not
+        be deleted, which is also added to `numFailedAcks`.
+        """
+        if self.heartbeat is not None:
+            self.heartbeat.release(receiptHandles)
+        numFailed = 0
+        for batchStart in range(0, len(receiptHandles), SQSClient.maxBatchEntries):
+            entries = {
+                str(entryId): receiptHandle
+                for entryId, receiptHandle in enumerate(
+                    receiptHandles[batchStart : batchStart + SQSClient.maxBatchEntries]
+                )
+            }
+            for attempt in range(self.maxDeleteRetries + 1):
+                if attempt:
+                    time.sleep(
+                        SQSClient.retryDelay(
+                            attempt, self.retryBaseDelay, self.maxRetryDelay
+                        )
+                    )
+                try:
+                    response = self.sqs.delete_message_batch(
+                        QueueUrl=self.queueUrl,
+                        Entries=[
+                            {"Id": entryId, "ReceiptHandle": receiptHandle}
+                            for entryId, receiptHandle in entries.items()
+                        ],
+                    )
+                except Exception as e:
+                    print("SQSClient.deleteMessages: delete_message_batch failed.", e)
+                    continue
+                # Sender faults are permanent (e.g. expired receipt handles) so
+                # only retry the entries that failed on the service side.
+                failed = response.get("Failed", [])
+                for failure in failed:
+                    if failure.get("SenderFault", False):
+                        print(
+                            "SQSClient.deleteMessages: Could not delete message.",
+                            failure.get("Code"),
+                            failure.get("Message"),
+                        )
+                        numFailed += 1
+                entries = {
+                    failure["Id"]: entries[failure["Id"]]
+                    for failure in failed
+                    if not failure.get("SenderFault", False)
+                }
+                if not entries:
+                    break
+            numFailed += len(entries)
+
+        self.numFailedAcks += numFailed
+        return numFailed
+
+    def changeMessageVisibility(self, receiptHandles, visibilityTimeout):
+        """
+        Set the visibility timeout of the specified messages using
+        `change_message_visibility_batch` requests of up to 10 entries.
+        Returns the number of messages whose visibility could not be changed.
+        """
+        if self.heartbeat is not None and visibilityTimeout == 0:
+            self.heartbeat.release(receiptHandles)
+        numFailed = 0
+        for batchStart in range(0, len(receiptHandles), SQSClient.maxBatchEntries):
+            entries = [
+                {
+                    "Id": str(entryId),
+                    "ReceiptHandle": receiptHandle,
+                    "VisibilityTimeout": visibilityTimeout,
+                }
+                for entryId, receiptHandle in enumerate(
+                    receiptHandles[batchStart : batchStart + SQSClient.maxBatchEntries]
+                )
+            ]
+            try:
+                response = self.sqs.change_message_visibility_batch(
+                    QueueUrl=self.queueUrl, Entries=entries
+                )
+                numFailed += len(response.get("Failed", []))
+            except Exception as e:
+                print(
+                    "SQSClient.changeMessageVisibility: change_message_visibility_batch failed.",
+                    e,
+                )
+                numFailed += len(entries)
+        return numFailed
+
+    def popInFlightReceiptHandles(self):
+        receiptHandles = self.inFlightReceiptHandles
+        self.inFlightReceiptHandles = []
+        return receiptHandles
+
+    def releaseInFlightMessages(self):
+        # Make the messages visible again immediately so that they can be
+        # redelivered without waiting for the visibility timeout to expire.
+        numFailed = self.changeMessageVisibility(self.inFlightReceiptHandles, 0)
+        self.inFlightReceiptHandles = []
+        return numFailed
+
+    def close(self):
+        """
+        Stop any concurrent pollers and make the messages they buffered, along
+        with any unacknowledged in-flight messages, visible again.
+        """
+        if self.pollerPool is not None:
+            bufferedMessages = self.pollerPool.stop()
+            self.pollerPool = None
+            self.changeMessageVisibility(
+                [message["ReceiptHandle"] for message in bufferedMessages], 0
+            )
+        if self.inFlightReceiptHandles:
+            self.releaseInFlightMessages()
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            self.heartbeat = None
+
     def putMessages(self, messages, purge=False):
         if purge:
-            sqsResource = boto3.resource("sqs")
-            queue = sqsResource.Queue(self.queueUrl)
-            queue.purge()
-
-        for message in messages:
-            if type(message) == dict:
-                self.sqs.send_message(
-                    QueueUrl=self.queueUrl, MessageBody=json.dumps(message)
+            self.sqs.purge_queue(QueueUrl=self.queueUrl)
+
+        messageBodies = [
+            json.dumps(message) for message in messages if type(message) == dict
+        ]
+        batches, oversizeBodies = self.packMessageBatches(messageBodies)
+        for messageBody in oversizeBodies:
+            print(
+                "SQSClient.putMessages: Message of {} bytes exceeds the SQS payload limit.".format(
+                    len(messageBody.encode())
                 )
+            )
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.numSenderThreads
+        ) as executor:
+            batchResults = list(executor.map(self.sendMessageBatch, batches))
+
+        numSent = sum(batchNumSent for batchNumSent, _ in batchResults)
+        failedBodies = oversizeBodies + [
+            messageBody
+            for _, batchFailedBodies in batchResults
+            for messageBody in batchFailedBodies
+        ]
         print(
-            'SQSClient posted {} messages to "{}""'.format(len(messages), self.queueUrl)
+            'SQSClient posted {} messages to "{}"" ({} failed)'.format(
+                numSent, self.queueUrl, len(failedBodies)
+            )
         )
+        return {
+            "sent": numSent,
+            "failed": len(failedBodies),
+            "failedMessages": [json.loads(messageBody) for messageBody in failedBodies],
+        }
+
+    @staticmethod
+    def packMessageBatches(messageBodies):
+        """
+        Group message bodies into batches that respect the SQS limits on the
+        number of entries and the total payload size of a batch request.
+        Returns the batches and a list of bodies that are too large to send.
+        """
+        batches = []
+        oversizeBodies = []
+        batch = []
+        batchBytes = 0
+        for messageBody in messageBodies:
+            messageBytes = len(messageBody.encode())
+            if messageBytes > SQSClient.maxBatchPayloadBytes:
+                oversizeBodies.append(messageBody)
+                continue
+            if (
+                len(batch) == SQSClient.maxBatchEntries
+                or batchBytes + messageBytes > SQSClient.maxBatchPayloadBytes
+            ):
+                batches.append(batch)
+                batch = []
+                batchBytes = 0
+            batch.append(messageBody)
+            batchBytes += messageBytes
+        if batch:
+            batches.append(batch)
+        return batches, oversizeBodies
+
+    def sendMessageBatch(self, messageBodies):
+        """
+        Send a batch of message bodies using `send_message_batch`, retrying
+        entries that fail on the service side up to `maxSendRetries` times,
+        with an exponential backoff.
+        Returns the number of messages sent and a list of the bodies that
+        could not be sent.
+        """
+        entries = {str(entryId): body for entryId, body in enumerate(messageBodies)}
+        failedBodies = []
+        numSent = 0
+        for attempt in range(self.maxSendRetries + 1):
+            if attempt:
+                time.sleep(
+                    SQSClient.retryDelay(attempt, self.retryBaseDelay, self.maxRetryDelay)
+                )
+            try:
+                response = self.sqs.send_message_batch(
+                    QueueUrl=self.queueUrl,
+                    Entries=[
+                        {"Id": entryId, "MessageBody": body}
+                        for entryId, body in entries.items()
+                    ],
+                )
+            except Exception as e:
+                print("SQSClient.sendMessageBatch: send_message_batch failed.", e)
+                continue
+            numSent += len(response.get("Successful", []))
+            failed = response.get("Failed", [])
+            for failure in failed:
+                if failure.get("SenderFault", False):
+                    print(
+                        "SQSClient.sendMessageBatch: Could not send message.",
+                        failure.get("Code"),
+                        failure.get("Message"),
+                    )
+                    failedBodies.append(entries[failure["Id"]])
+            entries = {
+                failure["Id"]: entries[failure["Id"]]
+                for failure in failed
+                if not failure.get("SenderFault", False)
+            }
+            if not entries:
+                break
+        failedBodies.extend(entries.values())
+        return numSent, failedBodies
 
     def deduplicate(self, messageList):
-        return [
-            um.message
-            for um in set([UniqueMessage(message) for message in messageList])
-        ]
+        return SQSClient.deduplicateMessages(messageList, self.classificationIdIndex)
+
+    @staticmethod
+    def deduplicateMessages(messageList, classificationIdIndex=None):
+        """
+        Return the first message for each distinct classification ID, omitting
+        any classification IDs present in `classificationIdIndex`.
+        """
+        if not len(messageList):
+            return []
+        classificationIds = np.array(
+            [int(message["classification_id"]) for message in messageList],
+            dtype=np.int64,
+        )
+        _, firstIndices = np.unique(classificationIds, return_index=True)
+        firstIndices.sort()
+        if classificationIdIndex is not None:
+            firstIndices = firstIndices[
+                ~classificationIdIndex.contains(classificationIds[firstIndices])
+            ]
+        return [messageList[index] for index in firstIndices]
 
 class SQSOfflineClient:
     """
     Added by VM to facilitate parsing offline using downloaded datadump
     """
+
+    # Number of bytes used to detect rewritten dump files
+    fingerprintBytes = 4096
+    # Streamed records with more messages than this are reported, since each
+    # is held in memory in full while it is served
+    largeRecordSize = 10000
+
     def __init__(self, filename, sizeMetaDatumName="#fwhmImagePix", trainingMessagesOnly=False, removeAnonUsers=False, **kwargs):
 
         self.messagesFilename = filename
 
         self.mTimes = {}
-        self.allMessages = []
+        self.fileOffsets = {}
+        self.fileFingerprints = {}
+        # Columnar dumps are served through a view that materialises messages
+        # on demand. Columnar and pickled dumps cannot be mixed.
+        isColumnar = [ColumnarMessageDump.isColumnarDump(f) for f in np.atleast_1d(filename)]
+        if any(isColumnar) and not all(isColumnar):
+            raise ValueError("SQSOfflineClient: Columnar and pickled message dumps cannot be mixed.")
+        self.columnar = all(isColumnar)
+        self.allMessages = ColumnarMessageView() if self.columnar else []
+        self.loadedClassificationIds = ClassificationIdIndex()
         self.parsedCount = 0
         self.removeAnonUsers = removeAnonUsers
         self.trainingMessagesOnly = trainingMessagesOnly
+        # Filters are applied as the dumps are read, before messages are
+        # deduplicated (or, for columnar dumps, materialised). A declarative
+        # subjectMetadataFilter is applied here too; callables can only be
+        # applied by the parser.
+        subjectMetadataFilter = MessageFilter.fromSpec(kwargs.get("subjectMetadataFilter", None))
+        self.messageFilter = MessageFilter(
+            removeAnonUsers=removeAnonUsers,
+            trainingMessagesOnly=trainingMessagesOnly,
+            subjectMetadata=subjectMetadataFilter.subjectMetadata if subjectMetadataFilter is not None else None,
+            numShards=kwargs.get("numShards", 1),
+            shardIndex=kwargs.get("shardIndex", 0),
+        )
         self.sizeMetaDatumName = sizeMetaDatumName
 
-        if os.path.isfile("datastore/trainingFWHM.fits"):
-            self.trainingFWHM = fitsio.getdata("datastore/trainingFWHM.fits")
-        else:
-            self.trainingFWHM = None
+        # In streaming mode, messages are read from the dump files one record
+        # at a time as they are served, rather than being loaded up front. The
+        # position of the next message is held in `cursor`, which maps each
+        # filename to the offset of a record and the number of messages in
+        # that record that have been consumed. If a `cursorPath` is provided,
+        # then the cursor is saved after every batch and reloaded on restart.
+        # Older dumps written as a single pickled list are one record, and
+        # must be converted with `chunkDumpFile` before streaming them reduces
+        # memory use.
+        self.streaming = kwargs.get("streamMessages", False)
+        if self.streaming and self.columnar:
+            raise ValueError("SQSOfflineClient: Columnar message dumps are already read on demand and cannot be streamed.")
+        self.cursorPath = kwargs.get("cursorPath", None)
+        # Unless a batch size is passed to getMessages, batches have a fixed
+        # size (batchSize), a random size between 40 and 59 drawn from a
+        # generator seeded with batchSizeSeed, or, if serveAll is set, all
+        # remaining messages are served in one batch. Progress is printed
+        # every progressInterval batches.
+        self.batchSize = kwargs.get("batchSize", None)
+        self.batchSizeRandomState = np.random.RandomState(kwargs["batchSizeSeed"]) if kwargs.get("batchSizeSeed", None) is not None else np.random
+        self.serveAll = kwargs.get("serveAll", False)
+        self.progressInterval = kwargs.get("progressInterval", 10)
+        self.numServedBatches = 0
+        # Pickled dump files are read and filtered in this many processes
+        self.numLoaderProcesses = kwargs.get("numLoaderProcesses", 1)
+        self.cursor = {}
+        self.messageStream = None
+
+        # The table of training subject FWHMs is memory-mapped and indexed the
+        # first time that a served message lacks the size metadatum.
+        self.trainingFWHMPath = kwargs.get("trainingFWHMPath", "datastore/trainingFWHM.fits")
+        self.trainingFWHM = None
+        self.trainingFWHMIndex = None
+        self.trainingFWHMLoaded = False
 
         self.loadMessages()
 
     def loadMessages(self):
 
-        for filename in np.atleast_1d(self.messagesFilename):
-            with open(filename,'rb') as pklfile:
-                messages = pickle.load(pklfile)
-                if self.removeAnonUsers:
-                    messages = [x for x in messages if x["user_id"] is not None]
-                if self.trainingMessagesOnly:
-                    messages = [x for x in messages if x["data"]["classification"]["subject"]["metadata"]["origin"]=="training"]
-                self.allMessages.extend(messages)
-            self.mTimes[filename] = os.stat(filename).st_mtime
-
-        self.messageIds = np.arange(len(self.allMessages))
-        print("SQSOfflineClient: Loaded {} messages ...".format(len(self.allMessages)))
+        if self.streaming:
+            if self.cursorPath is not None and os.path.isfile(self.cursorPath):
+                self.loadCursor()
+            self.messageStream = self.streamMessages()
+            print("SQSOfflineClient: Streaming messages from {} ...".format(", ".join(np.atleast_1d(self.messagesFilename))))
+            return
+
+        filenames = np.atleast_1d(self.messagesFilename)
+        if self.columnar:
+            for filename in filenames:
+                self.addColumnarRows(*self.readColumnarRows(filename))
+        elif self.numLoaderProcesses > 1 and len(filenames) > 1:
+            self.loadMessagesInParallel(filenames)
+        else:
+            for filename in filenames:
+                self.addMessages(self.readMessages(filename))
 
-    def update(self):
+        print("SQSOfflineClient: Loaded {} messages ...".format(len(self.allMessages)))
 
-        update = []
-        for filename in np.atleast_1d(self.messagesFilename):
-            update.append(os.stat(filename).st_mtime > self.mTimes[filename])
+    def loadMessagesInParallel(self, filenames):
+        # Files are merged in the order in which they were listed, so that the
+        # result (including which duplicate is kept) matches a serial load.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.numLoaderProcesses) as executor:
+            for filename, (messages, offset, fingerprint, mTime) in zip(
+                filenames,
+                executor.map(SQSOfflineClient.loadDumpFile, filenames, itertools.repeat(self.messageFilter)),
+            ):
+                self.fileOffsets[filename] = offset
+                self.fileFingerprints[filename] = fingerprint
+                self.mTimes[filename] = mTime
+                self.addFilteredMessages(messages)
+
+    @staticmethod
+    def loadDumpFile(filename, messageFilter):
+        """
+        Read all of the messages in a pickled dump file, then filter and
+        deduplicate them. Returns the messages together with the state that
+        `update` uses to read the file incrementally. Called in the loader
+        processes.
+        """
+        offset = 0
+        messages = []
+        for _, offset, records in SQSOfflineClient.readRecords(filename):
+            messages.extend(messageFilter.filterMessages(records))
+        with open(filename, 'rb') as pklfile:
+            fingerprint = SQSOfflineClient.readFingerprint(pklfile, offset)
+        return SQSClient.deduplicateMessages(messages), offset, fingerprint, os.stat(filename).st_mtime
 
-        if any(update):
+    def update(self):
 
-            allMessages = []
-            for filename in np.atleast_1d(self.messagesFilename):
-                with open(filename,'rb') as pklfile:
-                    messages = pickle.load(pklfile)
-                    if self.removeAnonUsers:
-                        messages = [x for x in messages if x["user_id"] is not None]
-                    if self.trainingMessagesOnly:
-                        messages = [x for x in messages if x["data"]["classification"]["subject"]["metadata"]["origin"]=="training"]
-                    allMessages.extend(messages)
-                self.mTimes[filename] = os.stat(filename).st_mtime
+        if self.streaming:
+            # Resume from the cursor, picking up any records appended since
+            # the stream was exhausted.
+            self.messageStream = self.streamMessages()
+            return
 
-            cond = np.in1d([_["classification_id"] for _ in allMessages],
-                           [_["classification_id"] for _ in self.allMessages])
-            cidx = np.where(~cond)[0]
-            print("SQSOfflineClient: Updated with {} new messages ...".format(len(cidx)))
+        numMessages = len(self.allMessages)
+        for filename in np.atleast_1d(self.messagesFilename):
+            if self.columnar:
+                # A dump that is being replaced by a new conversion is briefly
+                # absent, in which case it is read on the next update.
+                try:
+                    if os.stat(os.path.join(filename, "meta.json")).st_mtime > self.mTimes[filename]:
+                        self.addColumnarRows(*self.readColumnarRows(filename))
+                except FileNotFoundError:
+                    print("SQSOfflineClient: {} is being replaced. Skipping update ...".format(filename))
+                continue
+            fileStat = os.stat(filename)
+            if fileStat.st_mtime > self.mTimes[filename] or fileStat.st_size != self.fileOffsets[filename]:
+                self.addMessages(self.readMessages(filename))
+
+        if len(self.allMessages) > numMessages:
+            print("SQSOfflineClient: Updated with {} new messages ...".format(len(self.allMessages) - numMessages))
+
+    @staticmethod
+    def appendMessages(filename, messages):
+        """
+        Append a list of messages to a dump file as a separate pickle record,
+        so that `update` only needs to read the new record.
+        """
+        with open(filename, 'ab') as pklfile:
+            pickle.dump(list(messages), pklfile)
+
+    @staticmethod
+    def chunkDumpFile(filename, recordSize=1000, outputFilename=None):
+        """
+        Rewrite a pickled dump file as a sequence of records of at most
+        `recordSize` messages, so that it can be streamed one small record at
+        a time. Each record of the original file is loaded in full, so this is
+        intended as a one-off conversion of dumps written as a single pickled
+        list. The file is replaced atomically unless `outputFilename` is
+        given. Record offsets change, so any saved streaming cursor for the
+        file must be discarded.
+
+        Returns the number of records written.
+        """
+        if outputFilename is None:
+            outputFilename = filename
+        tmpFilename = "{}.tmp{}".format(outputFilename, os.getpid())
+        numRecords = 0
+        with open(tmpFilename, 'wb') as pklfile:
+            for _, _, records in SQSOfflineClient.readRecords(filename):
+                for recordStart in range(0, len(records), recordSize):
+                    pickle.dump(records[recordStart:recordStart + recordSize], pklfile)
+                    numRecords += 1
+        os.replace(tmpFilename, outputFilename)
+        return numRecords
+
+    def readMessages(self, filename):
+        """
+        Read the messages in the pickle records appended to `filename` since it
+        was last read. Dump files may contain a single pickled list of messages
+        or a sequence of appended records. If the content that was previously
+        read has changed, then the file is read again from the beginning.
+        """
+        offset = self.fileOffsets.get(filename, 0)
+        if offset:
+            with open(filename, 'rb') as pklfile:
+                if SQSOfflineClient.readFingerprint(pklfile, offset) != self.fileFingerprints[filename]:
+                    print("SQSOfflineClient: {} has been rewritten. Rereading ...".format(filename))
+                    offset = 0
+
+        messages = []
+        for _, offset, records in SQSOfflineClient.readRecords(filename, offset):
+            messages.extend(records)
+
+        with open(filename, 'rb') as pklfile:
+            self.fileFingerprints[filename] = SQSOfflineClient.readFingerprint(pklfile, offset)
+
+        self.fileOffsets[filename] = offset
+        self.mTimes[filename] = os.stat(filename).st_mtime
+        return messages
 
-            self.allMessages.extend([allMessages[idx] for idx in cidx])
-            self.messageIds = np.arange(len(self.allMessages))
+    @staticmethod
+    def readRecords(filename, offset=0):
+        """
+        Generate (record offset, next record offset, messages) for each complete
+        pickle record in `filename`, starting from the record at `offset`.
+        """
+        with open(filename, 'rb') as pklfile:
+            pklfile.seek(offset)
+            while True:
+                try:
+                    records = pickle.load(pklfile)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, IndexError) as e:
+                    # A record that is still being written will be read later.
+                    print("SQSOfflineClient: Incomplete record in {}.".format(filename), e)
+                    break
+                nextOffset = pklfile.tell()
+                yield offset, nextOffset, records if isinstance(records, list) else [records]
+                offset = nextOffset
+
+    def streamMessages(self):
+        """
+        Generate the filtered, deduplicated messages in the dump files,
+        starting from the cursor. Only one pickle record is held in memory at
+        a time, so a dump written as a single pickled list is loaded in full
+        unless it has been converted with `chunkDumpFile`.
+        """
+        for filename in np.atleast_1d(self.messagesFilename):
+            offset, skip = self.cursor.get(filename, (0, 0))
+            if os.path.getsize(filename) < offset:
+                print("SQSOfflineClient: {} has been rewritten. Rereading ...".format(filename))
+                offset, skip = 0, 0
+            for recordOffset, nextOffset, records in SQSOfflineClient.readRecords(filename, offset):
+                if len(records) > SQSOfflineClient.largeRecordSize:
+                    print("SQSOfflineClient: Streaming a record of {} messages from {}. Convert the file with SQSOfflineClient.chunkDumpFile to reduce memory use.".format(len(records), filename))
+                for position in range(skip, len(records)):
+                    self.cursor[filename] = (recordOffset, position + 1)
+                    message = records[position]
+                    if not self.messageFilter.accepts(message) or self.loadedClassificationIds.contains([message["classification_id"]])[0]:
+                        continue
+                    self.loadedClassificationIds.add([message["classification_id"]])
+                    yield message
+                self.cursor[filename] = (nextOffset, 0)
+                skip = 0
+
+    def saveCursor(self):
+        tmpPath = self.cursorPath + ".tmp"
+        with open(tmpPath, 'w') as cursorFile:
+            json.dump({"parsedCount": self.parsedCount, "cursor": self.cursor}, cursorFile)
+        os.replace(tmpPath, self.cursorPath)
+
+    def loadCursor(self):
+        with open(self.cursorPath) as cursorFile:
+            savedCursor = json.load(cursorFile)
+        self.parsedCount = savedCursor["parsedCount"]
+        self.cursor = {filename: tuple(position) for filename, position in savedCursor["cursor"].items()}
+
+        # Rebuild the index of served classification IDs from the messages
+        # that precede the cursor, so that duplicates are still removed.
+        for filename, (offset, skip) in self.cursor.items():
+            for recordOffset, _, records in SQSOfflineClient.readRecords(filename):
+                if recordOffset > offset:
+                    break
+                if recordOffset == offset:
+                    records = records[:skip]
+                self.loadedClassificationIds.add([m["classification_id"] for m in self.messageFilter.filterMessages(records)])
+
+        print("SQSOfflineClient: Resuming after {} served classifications from {}".format(self.parsedCount, self.cursorPath))
+
+    def readColumnarRows(self, filename):
+        """
+        Open the columnar dump at `filename` and return it with all of its
+        rows. A reconverted dump may have new rows anywhere (e.g. when one of
+        several input files has grown), so every row is masked again and rows
+        whose classification IDs have already been loaded are removed by
+        `addColumnarRows`. Both operate on whole columns, so this stays cheap.
+        """
+        dump = ColumnarMessageDump(filename)
+        self.mTimes[filename] = os.stat(os.path.join(filename, "meta.json")).st_mtime
+        return dump, np.arange(len(dump))
+
+    @staticmethod
+    def readFingerprint(pklfile, offset):
+        # The bytes at the start of the file and immediately before `offset`
+        # identify the content that has already been read.
+        pklfile.seek(0)
+        head = pklfile.read(min(offset, SQSOfflineClient.fingerprintBytes))
+        pklfile.seek(max(0, offset - SQSOfflineClient.fingerprintBytes))
+        tail = pklfile.read(min(offset, SQSOfflineClient.fingerprintBytes))
+        return head, tail
+
+    def addColumnarRows(self, dump, rows):
+        # Equivalent to addMessages, operating on the columns of the dump
+        rows = rows[self.messageFilter.columnarMask(dump, rows)]
+        classificationIds = dump.columns["classification_id"][rows]
+        _, firstIndices = np.unique(classificationIds, return_index=True)
+        firstIndices.sort()
+        rows = rows[firstIndices]
+        rows = rows[~self.loadedClassificationIds.contains(classificationIds[firstIndices])]
+        self.loadedClassificationIds.add(dump.columns["classification_id"][rows])
+        self.allMessages.extend(dump, rows)
+
+    def addMessages(self, messages):
+        self.addFilteredMessages(self.messageFilter.filterMessages(messages))
+
+    def addFilteredMessages(self, messages):
+        # Only messages with previously unseen classification IDs are added
+        newMessages = SQSClient.deduplicateMessages(messages, self.loadedClassificationIds)
+        self.loadedClassificationIds.add([m["classification_id"] for m in newMessages])
+        self.allMessages.extend(newMessages)
+
+    def getTrainingFWHMIndex(self):
+        """
+        Return a dict mapping the subject IDs in the training FWHM table to
+        their FWHMs (the first entry is used for repeated IDs), or None if
+        there is no table.
+        """
+        if not self.trainingFWHMLoaded:
+            self.trainingFWHMLoaded = True
+            if os.path.isfile(self.trainingFWHMPath):
+                self.trainingFWHM = fitsio.getdata(self.trainingFWHMPath, memmap=True)
+                tableIds, firstRows = np.unique(self.trainingFWHM["id"].astype(str), return_index=True)
+                self.trainingFWHMIndex = dict(zip(tableIds.tolist(), self.trainingFWHM["fwhmImagePix"][firstRows]))
+        return self.trainingFWHMIndex
 
     def addTrainingFWHM(self, messages):
 
-        if self.trainingFWHM is not None:
-
-            for message in messages:
+        missingMetadata = [
+            metadata
+            for metadata in (m["data"]["classification"]["subject"]["metadata"] for m in messages)
+            if self.sizeMetaDatumName not in metadata
+        ]
+        if not missingMetadata or self.getTrainingFWHMIndex() is None:
+            return messages
 
-                metadata = message["data"]["classification"]["subject"]["metadata"]
-                if self.sizeMetaDatumName in metadata:
-                    pass
-                elif metadata["id"] in self.trainingFWHM["id"].astype(str):
-                    idx = np.where(metadata["id"] == self.trainingFWHM["id"].astype(str))[0][0]
-                    metadata[self.sizeMetaDatumName] = self.trainingFWHM["fwhmImagePix"][idx]
-                else:
-                    print("No {} found in message or additional metadata for ID#{}".format(self.sizeMetaDatumName,metadata["id"]))
-                    pass
+        for metadata in missingMetadata:
+            fwhm = self.trainingFWHMIndex.get(metadata["id"])
+            if fwhm is not None:
+                metadata[self.sizeMetaDatumName] = fwhm
+            else:
+                print("No {} found in message or additional metadata for ID#{}".format(self.sizeMetaDatumName,metadata["id"]))
 
         return messages
 
-    def getMessages(self, batchSize=None, delete=None):
-
-        maxCount = len(self.allMessages)
-        if self.parsedCount < maxCount:
-
-            if batchSize is None: batchSize = np.random.randint(40,60)
-            batchIds = self.messageIds[self.parsedCount:self.parsedCount+batchSize]
+    def nextBatchSize(self, batchSize):
+        # Returns None if all remaining messages are to be served
+        if batchSize is not None:
+            return batchSize
+        if self.serveAll:
+            return None
+        if self.batchSize is not None:
+            return self.batchSize
+        return self.batchSizeRandomState.randint(40,60)
 
-            messages = [self.allMessages[i] for i in batchIds]
-            messages = self.addTrainingFWHM(messages)
+    def getMessages(self, batchSize=None, delete=None):
 
-            receivedMessages = messages
-            receivedMessageIds = [m["classification_id"] for m in messages]
+        batchSize = self.nextBatchSize(batchSize)
+        if self.streaming:
+            messages = list(itertools.islice(self.messageStream, batchSize))
+        else:
+            # Slicing a list only copies references. Columnar views only
+            # materialise the messages in the slice.
+            messages = self.allMessages[self.parsedCount:None if batchSize is None else self.parsedCount+batchSize]
 
-            self.parsedCount += batchSize
+        if not messages:
+            return [], [], []
 
-            print("SQSOfflineClient: served {}/{} classifications".format(self.parsedCount,maxCount))
-            return messages, receivedMessages, receivedMessageIds
+        messages = self.addTrainingFWHM(messages)
+        self.parsedCount += len(messages)
+        self.numServedBatches += 1
+        if self.streaming and self.cursorPath is not None:
+            self.saveCursor()
 
-        else:
+        exhausted = batchSize is None or len(messages) < batchSize or (not self.streaming and self.parsedCount == len(self.allMessages))
+        if exhausted or not self.numServedBatches % self.progressInterval:
+            print("SQSOfflineClient: served {}/{} classifications".format(self.parsedCount, "?" if self.streaming else len(self.allMessages)))
 
-            return [], [], []
+        return messages, messages, [m["classification_id"] for m in messages]
@@ -1,12 +1,17 @@
 import numpy as np
 import pandas as pd
-import itertools
+
+from .ClassificationIdIndex import ClassificationIdIndex
+from .ClassificationStore import ClassificationStore
+from .MessageFilter import MessageFilter
+from .SubjectGeometryCache import SubjectGeometryCache
 
 
 class SQSMessageParser:
 
     defaultMarkWidth = 35
     defaultMarkHeight = 35
+    defaultImageDimensions = (400, 400)
 
     def __init__(self, **kwargs):
 
@@ -17,10 +22,37 @@ class SQSMessageParser:
         self.filterSubjectList = kwargs.get("filterSubjectList", [])
 
         self.taskLabel = kwargs.get("taskLabel", "T1")
-        self.allClassificationIds = set()
+        # If a (shared) index of previously seen classification IDs is
+        # supplied then its owner is responsible for adding new IDs to it.
+        self.classificationIdIndex = kwargs.get("classificationIdIndex", None)
+        self.commitClassificationIds = self.classificationIdIndex is None
+        if self.classificationIdIndex is None:
+            self.classificationIdIndex = ClassificationIdIndex()
+        # Parsers for different tasks of the same workflow may share a cache.
+        self.subjectGeometryCache = kwargs.get("subjectGeometryCache", None)
+        if self.subjectGeometryCache is None:
+            self.subjectGeometryCache = SubjectGeometryCache(
+                kwargs.get("maxCachedSubjects", 100000)
+            )
         self.processedClassifications = None
         self.aggregatorInputData = dict()
-        self.subjectMetadataFilter = kwargs.get("subjectMetadataFilter", lambda x: True)
+        # The subject metadata filter may be declarative (a dict mapping field
+        # names to accepted values, or a MessageFilter), or a callable that is
+        # passed the subject metadata of each message.
+        subjectMetadataFilter = kwargs.get("subjectMetadataFilter", None)
+        self.messageFilter = MessageFilter.fromSpec(subjectMetadataFilter)
+        if self.messageFilter is None:
+            self.messageFilter = MessageFilter()
+            self.subjectMetadataFilter = subjectMetadataFilter
+        else:
+            self.subjectMetadataFilter = None
+        # When subjects are sharded across aggregators, only the
+        # classifications of this aggregator's shard are parsed.
+        numShards = kwargs.get("numShards", 1)
+        if numShards > 1:
+            self.messageFilter = self.messageFilter.withShard(
+                numShards, kwargs.get("shardIndex", 0)
+            )
 
     def setMarkDimensions(self, **kwargs):
         self.markWidth = None
@@ -109,7 +141,15 @@ class SQSMessageParser:
             return None
 
     def processMessages(self, uniqueMessages):
-        classifications = self.extractClassifications(uniqueMessages)
+        return self.processExtractedClassifications(
+            self.extractClassifications(uniqueMessages)
+        )
+
+    def processExtractedClassifications(self, classifications):
+        """
+        Complete the processing of classifications previously returned by
+        `extractClassifications`, e.g. by a prefetching thread.
+        """
         if classifications is not None:
             self.processClassifications(classifications)
             self.genAggregatorInput()
@@ -117,29 +157,37 @@ class SQSMessageParser:
         else:
             return False
 
-    def extractClassifications(self, uniqueMessages):
+    def selectNewClassifications(self, uniqueMessages):
+        """
+        Return the classifications in `uniqueMessages` that have not been seen
+        before and pass the message filters, recording their IDs as seen.
+        """
+        messageIds = [message["classification_id"] for message in uniqueMessages]
+        isDuplicate = self.classificationIdIndex.contains(messageIds)
 
         classificationData = list(
             filter(
                 lambda x: x,
                 [
                     self.extractClassification(message)
-                    for message in uniqueMessages
-                    if message["classification_id"] not in self.allClassificationIds
-                    and self.subjectMetadataFilter(
-                        message["data"]["classification"]["subject"]["metadata"]
+                    for message, duplicate in zip(uniqueMessages, isDuplicate)
+                    if not duplicate
+                    and self.messageFilter.accepts(message)
+                    and (
+                        self.subjectMetadataFilter is None
+                        or self.subjectMetadataFilter(
+                            message["data"]["classification"]["subject"]["metadata"]
+                        )
                     )
                 ],
             )
         )
 
-        if self.allClassificationIds.intersection(
-            set([message["classification_id"] for message in uniqueMessages])
-        ):
+        if isDuplicate.any():
             duplicateMessageIds = [
-                message["classification_id"]
-                for message in uniqueMessages
-                if message["classification_id"] in self.allClassificationIds
+                messageId
+                for messageId, duplicate in zip(messageIds, isDuplicate)
+                if duplicate
             ]
             print(
                 "Message Parser: Duplicate classification IDs: {}".format(
@@ -147,9 +195,14 @@ class SQSMessageParser:
                 )
             )
 
-        self.allClassificationIds.update(
-            [message["classification_id"] for message in uniqueMessages]
-        )
+        if self.commitClassificationIds:
+            self.classificationIdIndex.add(messageIds)
+
+        return classificationData
+
+    def extractClassifications(self, uniqueMessages):
+
+        classificationData = self.selectNewClassifications(uniqueMessages)
 
         if len(classificationData):
             classificationsFrame = pd.DataFrame(classificationData)
@@ -172,8 +225,25 @@ class SQSMessageParser:
 
         return classificationsFrame.drop_duplicates(subset="id")
 
-    def processClassifications(self, classificationsFrame):
-        # print("Unique subject count", classificationsFrame.subject_id.unique().size)
+    def classificationColumn(self, classifications, name):
+        """
+        Return a list of the values of a column of a batch of classifications
+        returned by `extractClassifications`.
+        """
+        return classifications[name].tolist()
+
+    def takeClassificationRows(self, classifications, rows):
+        """
+        Return a copy of the given rows of a batch of classifications returned
+        by `extractClassifications`.
+        """
+        return classifications.iloc[rows].copy()
+
+    def selectTaskClassifications(self, classificationsFrame):
+        """
+        Return the classifications that have annotations for this parser's
+        task, with their markings and tools extracted.
+        """
         classificationsFrame["annotation_counts"] = classificationsFrame.loc[
             :, "annotations"
         ].apply(len)
@@ -202,94 +272,104 @@ class SQSMessageParser:
             lambda x: [mark["tool"] for mark in x[self.taskLabel][0]["value"]]
         )
 
-        markedClassificationsFrame[
-            "num_markings"
-        ] = markedClassificationsFrame.markings.apply(lambda x: len(x))
-
-        markedClassificationsFrame[
-            "image_dimensions"
-        ] = markedClassificationsFrame.metadata.apply(self.extractSubjectDimensions)
-
-        markedClassificationsFrame[
-            "box_widths"
-        ] = markedClassificationsFrame.subject.apply(self.extractBoxWidths)
-
-        markedClassificationsFrame[
-            "box_heights"
-        ] = markedClassificationsFrame.subject.apply(self.extractBoxHeights)
+        return markedClassificationsFrame
 
-        markedClassificationsFrame[
-            "image_dimensions"
-        ] = markedClassificationsFrame.image_dimensions.fillna(method="ffill").apply(
-            self.imageDimsToTuple
-        )
+    def computeSubjectGeometry(self, subject):
+        return {
+            "image_dimensions": None,
+            "box_width": self.extractBoxWidths(subject),
+            "box_height": self.extractBoxHeights(subject),
+        }
 
-        # On Zooniverse mobile some taps can be registered multiple times.
-        # Attempt to filter these taps.
-        markedClassificationsFrame[
-            "marking_separations"
-        ] = markedClassificationsFrame.markings.apply(
-            lambda x: [
-                (
-                    (firstId, secondId),
-                    np.hypot(
-                        firstMark[0] - secondMark[0], firstMark[1] - secondMark[1]
-                    ),
+    def subjectGeometry(self, subjectIds, subjects, metadata):
+        """
+        Return lists of the image dimensions, mark box widths and mark box
+        heights of each classification's subject, looked up in the subject
+        geometry cache.
+
+        A classification without image dimensions uses the dimensions reported
+        by any other classification of the same subject, or the default
+        dimensions if none has been seen.
+
+        Args:
+        subjectIds - The subject ID of each classification.
+        subjects - The subject data of each classification.
+        metadata - The metadata of each classification.
+        """
+        geometries = [
+            self.subjectGeometryCache.get(
+                subjectId, lambda subject=subject: self.computeSubjectGeometry(subject)
+            )
+            for subjectId, subject in zip(subjectIds, subjects)
+        ]
+        for geometry, classificationMetadata in zip(geometries, metadata):
+            if geometry["image_dimensions"] is None:
+                imageDims = self.extractSubjectDimensions(classificationMetadata)
+                if imageDims is not None:
+                    geometry["image_dimensions"] = self.imageDimsToTuple(imageDims)
+
+        imageDimensions = []
+        for subjectId, geometry in zip(subjectIds, geometries):
+            if geometry["image_dimensions"] is None:
+                print(
+                    "SQSMessageParser.subjectGeometry: No image dimensions for subject {}. Using default dimensions {}".format(
+                        subjectId, SQSMessageParser.defaultImageDimensions
+                    )
                 )
-                for (firstId, firstMark), (
-                    secondId,
-                    secondMark,
-                ) in itertools.combinations(enumerate(x), 2)
-            ]
-        )
-
-        markedClassificationsFrame[
-            "original_markings"
-        ] = markedClassificationsFrame.markings
-
-        markedClassificationsFrame["unique_mark_indices"] = markedClassificationsFrame[
-            [
-                "marking_separations",
-                "markings",
-                "num_markings",
-                "box_widths",
-                "box_heights",
-            ]
-        ].apply(
-            lambda x: list(range(len(x.markings)))
-            if x.num_markings <= 1
-            else np.unique(
-                [x.marking_separations[0][0][0]]
-                + [
-                    idPair[1]
-                    for (idPair, distance) in x.marking_separations
-                    if distance > 0.75 * (x.box_widths + x.box_heights)
-                ]
-            ).tolist(),
-            axis=1,
+                imageDimensions.append(SQSMessageParser.defaultImageDimensions)
+            else:
+                imageDimensions.append(geometry["image_dimensions"])
+
+        return (
+            imageDimensions,
+            [geometry["box_width"] for geometry in geometries],
+            [geometry["box_height"] for geometry in geometries],
         )
 
-        markedClassificationsFrame.markings = markedClassificationsFrame[
-            ["markings", "unique_mark_indices", "num_markings"]
-        ].apply(
-            lambda x: x.markings
-            if x.num_markings <= 1
-            else np.array(x.markings)[x.unique_mark_indices].tolist(),
-            axis=1,
+    def addSubjectGeometry(self, classificationsFrame):
+        """
+        Add the image dimensions and mark box sizes of each classification's
+        subject to `classificationsFrame`.
+        """
+        (
+            classificationsFrame["image_dimensions"],
+            classificationsFrame["box_widths"],
+            classificationsFrame["box_heights"],
+        ) = self.subjectGeometry(
+            classificationsFrame.subject_id.tolist(),
+            classificationsFrame.subject.tolist(),
+            classificationsFrame.metadata.tolist(),
         )
 
-        markedClassificationsFrame[
-            "num_filtered_markings"
-        ] = markedClassificationsFrame.markings.apply(lambda x: len(x))
+    def retireSubjects(self, subjectIds):
+        """
+        Remove subjects that will receive no further classifications, e.g.
+        because their aggregation has finished, from the subject geometry cache.
+        """
+        self.subjectGeometryCache.retire(subjectIds)
 
-        if self.processedClassifications is None:
-            self.processedClassifications = markedClassificationsFrame
+    def processClassifications(self, classificationsFrame):
+        # print("Unique subject count", classificationsFrame.subject_id.unique().size)
+        # Frames fanned out by SQSMultiTaskMessageParser have already been
+        # restricted to this task, with markings and subject geometry added.
+        if "markings" in classificationsFrame.columns:
+            markedClassificationsFrame = classificationsFrame
         else:
-            self.processedClassifications = pd.concat(
-                [self.processedClassifications, markedClassificationsFrame]
+            markedClassificationsFrame = self.selectTaskClassifications(
+                classificationsFrame
             )
-
-        self.processedClassifications.drop_duplicates(subset="id", inplace=True)
+            self.addSubjectGeometry(markedClassificationsFrame)
+
+        self.storeClassifications(
+            ids=markedClassificationsFrame.id.tolist(),
+            subjectIds=markedClassificationsFrame.subject_id.tolist(),
+            userIds=markedClassificationsFrame.user_id.tolist(),
+            imageDimensions=markedClassificationsFrame.image_dimensions.tolist(),
+            boxWidths=markedClassificationsFrame.box_widths.to_numpy(dtype=float),
+            boxHeights=markedClassificationsFrame.box_heights.to_numpy(dtype=float),
+            markings=markedClassificationsFrame.markings.tolist(),
+            tools=markedClassificationsFrame.tool.tolist(),
+        )
 
         # Spammer alarm:
         # 1) If a single user submits the majority of classifications
@@ -323,42 +403,147 @@ class SQSMessageParser:
         #         ),
         #     )
 
+    def storeClassifications(
+        self,
+        ids,
+        subjectIds,
+        userIds,
+        imageDimensions,
+        boxWidths,
+        boxHeights,
+        markings,
+        tools,
+    ):
+        """
+        Filter repeated taps from the marks of a batch of task classifications
+        and append the classifications to the store of processed
+        classifications.
+
+        Args:
+        boxWidths, boxHeights - Arrays of the mark box sizes of each
+        classification.
+        Other arguments are lists as passed to `ClassificationStore.append`.
+        """
+        # On Zooniverse mobile some taps can be registered multiple times.
+        # Attempt to filter these taps.
+        uniqueMarkIndices = SQSMessageParser.uniqueMarkIndices(
+            markings, 0.75 * (boxWidths + boxHeights)
+        )
+        filteredMarkings = [
+            [classificationMarks[index] for index in indices]
+            for classificationMarks, indices in zip(markings, uniqueMarkIndices)
+        ]
+        # The tools are not filtered, so the n filtered marks of a
+        # classification are paired with its first n tools.
+        pairedTools = [
+            classificationTools[: len(classificationMarks)]
+            for classificationMarks, classificationTools in zip(
+                filteredMarkings, tools
+            )
+        ]
+
+        if self.processedClassifications is None:
+            self.processedClassifications = ClassificationStore()
+        self.processedClassifications.append(
+            ids=ids,
+            subjectIds=subjectIds,
+            userIds=userIds,
+            imageDimensions=imageDimensions,
+            boxWidths=boxWidths,
+            boxHeights=boxHeights,
+            markings=filteredMarkings,
+            tools=pairedTools,
+        )
+
+    @staticmethod
+    def uniqueMarkIndices(markings, separationThresholds):
+        """
+        Return the indices of the marks in each classification that survive the
+        duplicate tap filter. The first mark is always kept, and every later
+        mark is kept if it is further than the classification's separation
+        threshold from at least one earlier mark.
+
+        Classifications are grouped by their number of marks so that the
+        pairwise separations of each group are computed as a single
+        (classifications, marks, marks) array.
+        """
+        uniqueIndices = [list(range(len(classificationMarks))) for classificationMarks in markings]
+        numMarkings = np.array([len(classificationMarks) for classificationMarks in markings], dtype=int)
+        for groupSize in np.unique(numMarkings[numMarkings > 1]):
+            groupRows = np.flatnonzero(numMarkings == groupSize)
+            groupMarks = np.array([markings[row] for row in groupRows], dtype=float)
+            separations = np.hypot(
+                groupMarks[:, :, np.newaxis, 0] - groupMarks[:, np.newaxis, :, 0],
+                groupMarks[:, :, np.newaxis, 1] - groupMarks[:, np.newaxis, :, 1],
+            )
+            # separations[k, i, j] is only considered for earlier marks i < j
+            isSeparated = np.triu(
+                separations > separationThresholds[groupRows, np.newaxis, np.newaxis], k=1
+            )
+            keepMarks = isSeparated.any(axis=1)
+            keepMarks[:, 0] = True
+            for row, keep in zip(groupRows, keepMarks):
+                uniqueIndices[row] = np.flatnonzero(keep).tolist()
+        return uniqueIndices
+
     def genAggregatorInput(self):
         dataset = dict()
         workers = dict()
+
+        columns = self.processedClassifications.columns()
+        keep = ~np.isin(columns["subject_id"], list(self.filterSubjectList))
+        keepMarks = np.repeat(keep, columns["num_marks"])
+
+        subjectIds = columns["subject_id"][keep]
+        imageWidths = columns["image_width"][keep].tolist()
+        imageHeights = columns["image_height"][keep].tolist()
+
+        _, firstRows = np.unique(subjectIds, return_index=True)
+        firstRows.sort()
         images = {
-            str(rowData.subject_id): {
-                "height": rowData.image_dimensions[1],
-                "width": rowData.image_dimensions[0],
+            str(subjectId): {
+                "height": imageHeights[row],
+                "width": imageWidths[row],
                 "url": "",
             }
-            for _, rowData in self.processedClassifications.drop_duplicates(
-                subset="subject_id"
-            ).iterrows()
-            if rowData.subject_id not in self.filterSubjectList
+            for row, subjectId in zip(firstRows.tolist(), subjectIds[firstRows].tolist())
         }
 
+        # The bounding boxes of all classifications are computed together from
+        # the flat array of marks.
+        markX = columns["x"][keepMarks]
+        markY = columns["y"][keepMarks]
+        boxWidths = np.repeat(columns["box_widths"], columns["num_marks"])[keepMarks]
+        boxHeights = np.repeat(columns["box_heights"], columns["num_marks"])[keepMarks]
+        boxX = (markX - 0.5 * boxHeights).tolist()
+        boxX2 = (markX + 0.5 * boxWidths).tolist()
+        boxY = (markY - 0.5 * boxHeights).tolist()
+        boxY2 = (markY + 0.5 * boxWidths).tolist()
+        boxTools = columns["tool"][keepMarks].tolist()
+        boxOffsets = np.concatenate([[0], np.cumsum(columns["num_marks"][keep])]).tolist()
+
         annos = [
             {
                 "anno": {
                     "bboxes": [
                         {
-                            "image_height": rowData.image_dimensions[1],
-                            "image_width": rowData.image_dimensions[0],
-                            "x": markData[0] - 0.5 * rowData.box_heights,
-                            "x2": markData[0] + 0.5 * rowData.box_widths,
-                            "y": markData[1] - 0.5 * rowData.box_heights,
-                            "y2": markData[1] + 0.5 * rowData.box_widths,
-                            "tool" : tool
+                            "image_height": imageHeights[row],
+                            "image_width": imageWidths[row],
+                            "x": boxX[box],
+                            "x2": boxX2[box],
+                            "y": boxY[box],
+                            "y2": boxY2[box],
+                            "tool": boxTools[box],
                         }
-                        for markData, tool in zip(rowData.markings, rowData.tool)
+                        for box in range(boxOffsets[row], boxOffsets[row + 1])
                     ]
                 },
-                "image_id": str(rowData.subject_id),
-                "worker_id": str(rowData.user_id),
+                "image_id": str(subjectId),
+                "worker_id": str(userId),
             }
-            for _, rowData in self.processedClassifications.iterrows()
-            if rowData.subject_id not in self.filterSubjectList
+            for row, (subjectId, userId) in enumerate(
+                zip(subjectIds.tolist(), columns["user_id"][keep].tolist())
+            )
         ]
 
         self.aggregatorInputData = dict(
@@ -372,7 +557,7 @@ class SQSMessageParser:
     def getNumProcessedClassifications(self):
         if self.processedClassifications is None:
             return 0
-        return len(self.processedClassifications.index)
+        return len(self.processedClassifications)
 
     def clearProcessedClassifications(self):
         if self.processedClassifications is not None:
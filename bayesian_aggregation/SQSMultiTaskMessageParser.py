@@ -0,0 +1,104 @@
+from .SQSMessageParser import SQSMessageParser
+
+
+class SQSMultiTaskMessageParser(SQSMessageParser):
+    """
+    Parses messages for several tasks at once.
+
+    Messages are deduplicated, filtered and decoded into a classification
+    frame once, and the subject geometry of each classification is extracted
+    once. A single pass over the annotations then fans the marks out to one
+    `SQSMessageParser` per task label, which produces the aggregator input for
+    its task.
+    """
+
+    taskParserClass = SQSMessageParser
+
+    def __init__(self, taskLabels, **kwargs):
+        """
+        Args:
+        taskLabels - The labels of the tasks to be parsed.
+        Other keyword arguments are passed to the per-task parsers.
+        """
+        kwargs.pop("taskLabel", None)
+        super().__init__(taskLabel=", ".join(taskLabels), **kwargs)
+        self.taskLabels = list(taskLabels)
+        # The per-task parsers never see raw messages, so they do not need
+        # their own record of previously seen classification IDs, and they
+        # share the subject geometry extracted here.
+        self.taskParsers = [
+            self.taskParserClass(
+                taskLabel=taskLabel,
+                **dict(
+                    kwargs,
+                    classificationIdIndex=self.classificationIdIndex,
+                    subjectGeometryCache=self.subjectGeometryCache,
+                )
+            )
+            for taskLabel in self.taskLabels
+        ]
+
+    def extractTaskClassifications(self, uniqueMessages):
+        """
+        Return a list containing the classifications of each task in
+        `uniqueMessages`, ready to be passed to the corresponding task parser's
+        `processExtractedClassifications`. If every message has already been
+        seen, then each list entry is None.
+        """
+        classifications = self.extractClassifications(uniqueMessages)
+        if classifications is None:
+            return [None] * len(self.taskLabels)
+
+        taskRows = {taskLabel: [] for taskLabel in self.taskLabels}
+        taskMarkings = {taskLabel: [] for taskLabel in self.taskLabels}
+        taskTools = {taskLabel: [] for taskLabel in self.taskLabels}
+        for row, annotations in enumerate(
+            self.classificationColumn(classifications, "annotations")
+        ):
+            for taskLabel in self.taskLabels:
+                if taskLabel not in annotations:
+                    continue
+                marks = annotations[taskLabel][0]["value"]
+                taskRows[taskLabel].append(row)
+                taskMarkings[taskLabel].append([(mark["x"], mark["y"]) for mark in marks])
+                taskTools[taskLabel].append([mark["tool"] for mark in marks])
+
+        markedRows = sorted(set().union(*taskRows.values()))
+        markedClassifications = self.takeClassificationRows(classifications, markedRows)
+        self.addSubjectGeometry(markedClassifications)
+        markedPositions = {row: position for position, row in enumerate(markedRows)}
+
+        taskClassifications = []
+        for taskLabel in self.taskLabels:
+            taskClassification = self.takeClassificationRows(
+                markedClassifications,
+                [markedPositions[row] for row in taskRows[taskLabel]],
+            )
+            taskClassification["markings"] = taskMarkings[taskLabel]
+            taskClassification["tool"] = taskTools[taskLabel]
+            taskClassifications.append(taskClassification)
+        return taskClassifications
+
+    def processMessages(self, uniqueMessages):
+        """
+        Parse `uniqueMessages` for every task. Returns True if any task
+        produced aggregator input.
+        """
+        processed = [
+            taskParser.processExtractedClassifications(classifications)
+            for taskParser, classifications in zip(
+                self.taskParsers, self.extractTaskClassifications(uniqueMessages)
+            )
+        ]
+        return any(processed)
+
+    def getAggregatorInputData(self):
+        return {
+            taskLabel: taskParser.getAggregatorInputData()
+            for taskLabel, taskParser in zip(self.taskLabels, self.taskParsers)
+        }
+
+    def clearProcessedClassifications(self):
+        for taskParser in self.taskParsers:
+            taskParser.clearProcessedClassifications()
+
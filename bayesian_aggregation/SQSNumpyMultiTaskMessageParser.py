@@ -0,0 +1,11 @@
+from .SQSMultiTaskMessageParser import SQSMultiTaskMessageParser
+from .SQSNumpyMessageParser import SQSNumpyMessageParser
+
+
+class SQSNumpyMultiTaskMessageParser(SQSMultiTaskMessageParser, SQSNumpyMessageParser):
+    """
+    Parses messages for several tasks at once without building pandas data
+    frames.
+    """
+
+    taskParserClass = SQSNumpyMessageParser
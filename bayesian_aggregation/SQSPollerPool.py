@@ -0,0 +1,84 @@
+import queue
+import threading
+
+
+class SQSPollerPool:
+    """
+    Pool of threads that long-poll an SQS queue concurrently and feed the raw
+    received messages into a bounded in-memory buffer.
+    """
+
+    def __init__(self, receive, numPollers=4, bufferSize=200, receiveSize=10):
+        """
+        Args:
+        receive - Callable that performs a single (long) poll of the queue and
+        returns a list of raw SQS messages.
+        numPollers - The number of concurrent polling threads.
+        bufferSize - The maximum number of messages held in the buffer. Pollers
+        stop receiving while the buffer cannot accommodate another receive.
+        receiveSize - The maximum number of messages returned by `receive`.
+        """
+        self.receive = receive
+        self.numPollers = numPollers
+        self.bufferSize = bufferSize
+        self.receiveSize = receiveSize
+        self.buffer = queue.Queue(maxsize=bufferSize)
+        self.stopEvent = threading.Event()
+        self.pollers = []
+
+    def start(self):
+        self.stopEvent.clear()
+        self.pollers = [
+            threading.Thread(
+                target=self.poll, name="SQSPoller-{}".format(pollerId), daemon=True
+            )
+            for pollerId in range(self.numPollers)
+        ]
+        for poller in self.pollers:
+            poller.start()
+
+    def poll(self):
+        while not self.stopEvent.is_set():
+            # Apply backpressure: messages that sit in the buffer are consuming
+            # their visibility timeout, so do not receive more than can be held.
+            if self.buffer.qsize() > self.bufferSize - self.receiveSize:
+                self.stopEvent.wait(0.1)
+                continue
+            try:
+                messages = self.receive()
+            except Exception as e:
+                print("SQSPollerPool: Receive failed.", e)
+                self.stopEvent.wait(1)
+                continue
+            for message in messages:
+                self.buffer.put(message)
+
+    def drain(self, maxMessages=None, timeout=20):
+        """
+        Return the messages currently held in the buffer (at most
+        `maxMessages`), waiting up to `timeout` seconds for the first one.
+        """
+        messages = []
+        try:
+            messages.append(self.buffer.get(timeout=timeout))
+            while maxMessages is None or len(messages) < maxMessages:
+                messages.append(self.buffer.get_nowait())
+        except queue.Empty:
+            pass
+        return messages
+
+    def stop(self, timeout=None):
+        """
+        Stop the pollers and return any messages left in the buffer.
+        """
+        self.stopEvent.set()
+        remaining = []
+        # Keep draining while the pollers finish any outstanding receive so
+        # that none of them can block on a full buffer.
+        while any(poller.is_alive() for poller in self.pollers):
+            remaining.extend(self.drain(timeout=0.1))
+            for poller in self.pollers:
+                poller.join(timeout=0.1 if timeout is None else timeout)
+        remaining.extend(self.drain(timeout=0))
+        self.pollers = []
+        return remaining
@@ -0,0 +1,64 @@
+import threading
+
+
+class SQSVisibilityHeartbeat:
+    """
+    Background thread that periodically extends the visibility timeout of
+    in-flight SQS messages until they are acknowledged or released.
+    """
+
+    def __init__(self, changeMessageVisibility, visibilityTimeout=40, interval=None):
+        """
+        Args:
+        changeMessageVisibility - Callable accepting a list of receipt handles
+        and a visibility timeout in seconds.
+        visibilityTimeout - The visibility timeout applied at each heartbeat.
+        interval - Seconds between heartbeats (default: half the visibility
+        timeout).
+        """
+        self.changeMessageVisibility = changeMessageVisibility
+        self.visibilityTimeout = visibilityTimeout
+        self.interval = interval if interval is not None else 0.5 * visibilityTimeout
+        self.receiptHandles = set()
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.thread = None
+        self.numExtensions = 0
+
+    def track(self, receiptHandles):
+        with self.lock:
+            self.receiptHandles.update(receiptHandles)
+
+    def release(self, receiptHandles):
+        with self.lock:
+            self.receiptHandles.difference_update(receiptHandles)
+
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="SQSVisibilityHeartbeat", daemon=True
+        )
+        self.thread.start()
+
+    def run(self):
+        while not self.stopEvent.wait(self.interval):
+            with self.lock:
+                receiptHandles = list(self.receiptHandles)
+            if receiptHandles:
+                self.changeMessageVisibility(receiptHandles, self.visibilityTimeout)
+                self.numExtensions += 1
+
+    def popExtensionCount(self):
+        """
+        Return the number of heartbeats that extended at least one message
+        since the last call.
+        """
+        numExtensions = self.numExtensions
+        self.numExtensions = 0
+        return numExtensions
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,180 @@
+import collections
+import multiprocessing
+import signal
+import traceback
+
+
+class SubAggregatorProcess:
+    """
+    Runs a sub-aggregator (e.g. a `CrowdDatasetBBox`) in a long-lived worker
+    process.
+
+    The worker receives method calls through a pipe, applies them to its
+    sub-aggregator and returns the results. Attributes and methods of the
+    sub-aggregator can be accessed through this proxy as if it were local, in
+    which case each access waits for the worker. Calls can also be submitted
+    without waiting with `submit` and their results collected later with
+    `result`, so that several workers run concurrently. When the worker is
+    closed its sub-aggregator is copied back, and the proxy then applies
+    accesses and calls to the copy in this process.
+
+    Workers are not forked from the aggregator itself, which may already be
+    running SQS poller and heartbeat threads whose locks a forked child
+    could inherit in a held state. They are started from a forkserver
+    (or spawned where that is unavailable), so `createSubAggregator` and its
+    arguments must be picklable, and scripts that use worker processes must
+    guard their entry point with `if __name__ == "__main__":`.
+    """
+
+    startMethod = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn"
+    )
+
+    def __init__(self, createSubAggregator, name=None, **kwargs):
+        """
+        Args:
+        createSubAggregator - Picklable callable that creates the sub-aggregator
+        in the worker process.
+        name - The name of the worker process.
+        Other keyword arguments are passed to `createSubAggregator`.
+        """
+        context = multiprocessing.get_context(SubAggregatorProcess.startMethod)
+        connection, workerConnection = context.Pipe()
+        self.__dict__["connection"] = connection
+        self.__dict__["numPendingResults"] = 0
+        self.__dict__["callableAttributes"] = set()
+        self.__dict__["subAggregator"] = None
+        self.__dict__["localResults"] = collections.deque()
+        self.__dict__["process"] = context.Process(
+            target=SubAggregatorProcess.serve,
+            args=(workerConnection, createSubAggregator, kwargs),
+            name=name,
+            daemon=True,
+        )
+        self.process.start()
+        workerConnection.close()
+
+    @staticmethod
+    def serve(connection, createSubAggregator, kwargs):
+        # Interrupts are handled by the parent process.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        subAggregator = createSubAggregator(**kwargs)
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                return
+            action, name, args, kwargs = request
+            if action == "detach":
+                # Return the sub-aggregator and stop
+                try:
+                    connection.send(("result", subAggregator))
+                except Exception as e:
+                    connection.send(("error", (e, traceback.format_exc())))
+                return
+            try:
+                if action == "call":
+                    result = getattr(subAggregator, name)(*args, **kwargs)
+                elif action == "getattr":
+                    attribute = getattr(subAggregator, name)
+                    result = (True, None) if callable(attribute) else (False, attribute)
+                else:
+                    setattr(subAggregator, name, args[0])
+                    result = None
+                connection.send(("result", result))
+            except Exception as e:
+                connection.send(("error", (e, traceback.format_exc())))
+
+    def send(self, action, name, args=(), kwargs={}):
+        if self.connection.closed:
+            raise RuntimeError(
+                "SubAggregatorProcess: Worker process {} has been closed.".format(
+                    self.process.name
+                )
+            )
+        self.connection.send((action, name, args, kwargs))
+        self.__dict__["numPendingResults"] += 1
+
+    def result(self):
+        """
+        Wait for and return the result of the oldest call that has not yet
+        been collected. Exceptions raised by the call are re-raised.
+        """
+        if self.subAggregator is not None:
+            self.__dict__["numPendingResults"] -= 1
+            return self.localResults.popleft()
+        status, result = self.connection.recv()
+        self.__dict__["numPendingResults"] -= 1
+        if status == "error":
+            error, workerTraceback = result
+            print(
+                "SubAggregatorProcess: Error in worker process {}:\n{}".format(
+                    self.process.name, workerTraceback
+                )
+            )
+            raise error
+        return result
+
+    def submit(self, methodName, *args, **kwargs):
+        """
+        Call a method of the sub-aggregator without waiting for the result.
+        """
+        if self.subAggregator is not None:
+            self.localResults.append(
+                getattr(self.subAggregator, methodName)(*args, **kwargs)
+            )
+            self.__dict__["numPendingResults"] += 1
+            return
+        self.send("call", methodName, args, kwargs)
+
+    def call(self, methodName, *args, **kwargs):
+        self.submit(methodName, *args, **kwargs)
+        return self.result()
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if self.subAggregator is not None:
+            return getattr(self.subAggregator, name)
+        if name not in self.callableAttributes:
+            self.send("getattr", name)
+            isCallable, value = self.result()
+            if not isCallable:
+                return value
+            self.callableAttributes.add(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def __setattr__(self, name, value):
+        if self.subAggregator is not None:
+            setattr(self.subAggregator, name, value)
+            return
+        self.send("setattr", name, (value,))
+        self.result()
+
+    def close(self):
+        """
+        Stop the worker process, after collecting any outstanding results, and
+        copy its sub-aggregator into this process.
+        """
+        if self.subAggregator is not None or not self.process.is_alive():
+            return
+        while self.numPendingResults:
+            try:
+                self.result()
+            except Exception:
+                # Already reported by result()
+                pass
+        self.send("detach", None)
+        try:
+            self.__dict__["subAggregator"] = self.result()
+        except Exception as e:
+            print(
+                "SubAggregatorProcess: Could not copy the sub-aggregator of {} from the worker process.".format(
+                    self.process.name
+                ),
+                e,
+            )
+        self.process.join()
+        self.connection.close()
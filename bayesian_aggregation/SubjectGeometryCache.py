@@ -0,0 +1,50 @@
+import collections
+import threading
+
+
+class SubjectGeometryCache:
+    """
+    Bounded cache of the geometry of each subject, i.e. its image dimensions
+    and the width and height of the boxes drawn around its marks, keyed by
+    subject ID.
+
+    When the cache is full the least recently used subject is evicted.
+    Subjects whose aggregation has finished can be retired explicitly.
+    """
+
+    def __init__(self, maxSubjects=100000):
+        """
+        Args:
+        maxSubjects - The maximum number of subjects held in the cache.
+        """
+        self.maxSubjects = maxSubjects
+        self.lock = threading.Lock()
+        self.subjects = collections.OrderedDict()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.subjects)
+
+    def get(self, subjectId, computeGeometry):
+        """
+        Return the geometry of the subject, which is a dict with "box_width",
+        "box_height" and "image_dimensions" entries (the latter is None until
+        the dimensions are known). If the subject is not cached, then its
+        geometry is computed with `computeGeometry()` and cached.
+        """
+        with self.lock:
+            geometry = self.subjects.get(subjectId)
+            if geometry is not None:
+                self.subjects.move_to_end(subjectId)
+                return geometry
+        geometry = computeGeometry()
+        with self.lock:
+            self.subjects[subjectId] = geometry
+            while len(self.subjects) > self.maxSubjects:
+                self.subjects.popitem(last=False)
+        return geometry
+
+    def retire(self, subjectIds):
+        with self.lock:
+            for subjectId in subjectIds:
+                self.subjects.pop(subjectId, None)
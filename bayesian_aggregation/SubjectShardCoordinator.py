@@ -0,0 +1,274 @@
+import collections
+import json
+import os
+import pickle
+import time
+
+
+class SubjectShardCoordinator:
+    """
+    Exchanges worker-skill parameters between aggregators whose subjects are
+    partitioned into shards (see `MessageFilter.subjectShard`).
+
+    Each shard learns the skills of its workers from their classifications of
+    the shard's subjects only. After every round of aggregation each shard
+    publishes the encoded parameters of its workers, together with the number
+    of annotations each worker has made in the shard, to a directory shared by
+    all shards (e.g. a local or network file system). It then waits for the
+    other shards to publish the same round and merges their parameters into
+    its own. A shard that has no batch to aggregate publishes that it is idle,
+    so that the other shards merge its latest parameters without waiting for
+    it.
+
+    For each worker the merged parameters are those of the shard in which the
+    worker has made the most annotations, with every scalar numeric parameter
+    replaced by its average over the shards weighted by annotation counts.
+
+    Files left in the exchange directory by earlier runs must not be mistaken
+    for the current run's. If the shards are given a shared run ID, then their
+    file names include it. Otherwise files last modified before the
+    coordinator was created are ignored, so a restarted shard does not merge
+    the stale parameters of the other shards. In this case a shard that is
+    restarted while the others keep running will not wait for or merge shards
+    that finished before its restart.
+    """
+
+    def __init__(self, numShards, shardIndex, exchangeDir, **kwargs):
+        """
+        Args:
+        numShards - The number of shards.
+        shardIndex - The index of this shard.
+        exchangeDir - The directory shared by all shards.
+        exchangeTimeout - The maximum time in seconds to wait for the other
+        shards to publish a round. Parameters from shards that have not
+        published the round in time are merged from the latest round they
+        did publish.
+        pollInterval - The time in seconds between checks for the other
+        shards' progress.
+        runId - Optional ID of the run, shared by all of its shards, that
+        scopes the exchanged files.
+        """
+        self.numShards = numShards
+        self.shardIndex = shardIndex
+        self.exchangeDir = exchangeDir
+        self.exchangeTimeout = kwargs.get("exchangeTimeout", 300)
+        self.pollInterval = kwargs.get("pollInterval", 1.0)
+        self.runId = kwargs.get("runId", None)
+        # File modification times come from a coarser clock than time.time(),
+        # so allow for files written just after the coordinator started
+        # appearing slightly older.
+        self.startTime = time.time() - 1.0
+        os.makedirs(self.exchangeDir, exist_ok=True)
+        # Discard the status of a previous run of this shard
+        if os.path.exists(self.statusPath(self.shardIndex)):
+            os.remove(self.statusPath(self.shardIndex))
+        self.annotationCounts = collections.defaultdict(collections.Counter)
+
+    def runPrefix(self):
+        return "" if self.runId is None else "{}_".format(self.runId)
+
+    def workersPath(self, taskLabel, shardIndex):
+        return os.path.join(
+            self.exchangeDir,
+            "{}workers_{}_shard{}.pkl".format(self.runPrefix(), taskLabel, shardIndex),
+        )
+
+    def statusPath(self, shardIndex):
+        return os.path.join(
+            self.exchangeDir,
+            "{}status_shard{}.json".format(self.runPrefix(), shardIndex),
+        )
+
+    def isCurrent(self, file):
+        """
+        Return False if an open exchange file was left by an earlier run.
+        """
+        return (
+            self.runId is not None
+            or os.fstat(file.fileno()).st_mtime >= self.startTime
+        )
+
+    @staticmethod
+    def writeAtomically(path, data, binary):
+        temporaryPath = path + ".tmp"
+        with open(temporaryPath, mode="wb" if binary else "w") as file:
+            if binary:
+                pickle.dump(obj=data, file=file)
+            else:
+                json.dump(data, file)
+        os.replace(temporaryPath, path)
+
+    def countAnnotations(self, taskLabel, annos):
+        """
+        Record the annotations of a batch of aggregator input for a task.
+        """
+        self.annotationCounts[taskLabel].update(anno["worker_id"] for anno in annos)
+
+    def publish(self, roundIndex, taskWorkers, finished=False):
+        """
+        Publish the encoded worker parameters of each task after a round.
+
+        Args:
+        roundIndex - The index of the round.
+        taskWorkers - Dict mapping task labels to dicts of encoded worker
+        parameters.
+        finished - If True, the other shards stop waiting for this one.
+        """
+        for taskLabel, workers in taskWorkers.items():
+            SubjectShardCoordinator.writeAtomically(
+                self.workersPath(taskLabel, self.shardIndex),
+                dict(workers=workers, counts=dict(self.annotationCounts[taskLabel])),
+                binary=True,
+            )
+        # The status is written last, so that the other shards only read
+        # complete rounds.
+        self.publishStatus(roundIndex, finished=finished)
+
+    def publishStatus(self, roundIndex, finished=False, idle=False):
+        SubjectShardCoordinator.writeAtomically(
+            self.statusPath(self.shardIndex),
+            dict(round=roundIndex, finished=finished, idle=idle),
+            binary=False,
+        )
+
+    def idle(self, roundIndex):
+        """
+        Publish that this shard has no batch to aggregate, so that the other
+        shards do not wait for it until it publishes a new round. Meanwhile
+        they merge the parameters it published with its latest round.
+
+        Args:
+        roundIndex - The index of the latest round published by this shard
+        (-1 if none).
+        """
+        self.publishStatus(roundIndex, idle=True)
+
+    def readStatus(self, shardIndex):
+        try:
+            with open(self.statusPath(shardIndex)) as statusFile:
+                if not self.isCurrent(statusFile):
+                    return None
+                return json.load(statusFile)
+        except FileNotFoundError:
+            return None
+
+    def waitForShards(self, roundIndex):
+        """
+        Wait until every other shard has published `roundIndex` (or a later
+        round), is idle or has finished, or the exchange timeout expires.
+        """
+        otherShards = [
+            shardIndex
+            for shardIndex in range(self.numShards)
+            if shardIndex != self.shardIndex
+        ]
+        deadline = time.time() + self.exchangeTimeout
+        while True:
+            waitingShards = []
+            idleShards = []
+            for shardIndex in otherShards:
+                status = self.readStatus(shardIndex)
+                if status is None:
+                    waitingShards.append(shardIndex)
+                elif status["finished"] or status["round"] >= roundIndex:
+                    continue
+                elif status.get("idle", False):
+                    idleShards.append(shardIndex)
+                else:
+                    waitingShards.append(shardIndex)
+            if not waitingShards:
+                if idleShards:
+                    print(
+                        "SubjectShardCoordinator: Shards {} are idle. Merging their latest parameters for round {}.".format(
+                            idleShards, roundIndex
+                        )
+                    )
+                return
+            if time.time() > deadline:
+                print(
+                    "SubjectShardCoordinator: Shards {} did not publish round {} within {} seconds. Merging their latest parameters.".format(
+                        waitingShards, roundIndex, self.exchangeTimeout
+                    )
+                )
+                return
+            time.sleep(self.pollInterval)
+
+    def readShardWorkers(self, taskLabel, shardIndex):
+        try:
+            with open(self.workersPath(taskLabel, shardIndex), mode="rb") as workersFile:
+                if not self.isCurrent(workersFile):
+                    return None
+                return pickle.load(workersFile)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def isScalar(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    @staticmethod
+    def mergeWorkers(shardWorkers, workerIds):
+        """
+        Merge the encoded parameters of the workers in `workerIds`.
+
+        Args:
+        shardWorkers - List of dicts with "workers" (encoded parameters) and
+        "counts" (annotation counts) entries, one per shard.
+        workerIds - The IDs of the workers to merge.
+        """
+        mergedWorkers = {}
+        for workerId in workerIds:
+            encodings = [
+                (shard["workers"][workerId], shard["counts"].get(workerId, 0))
+                for shard in shardWorkers
+                if workerId in shard["workers"]
+            ]
+            totalCount = sum(count for _, count in encodings)
+            dominantEncoding = max(encodings, key=lambda encoding: encoding[1])[0]
+            if totalCount == 0 or not isinstance(dominantEncoding, dict):
+                mergedWorkers[workerId] = dominantEncoding
+                continue
+            mergedWorkers[workerId] = {
+                key: sum(encoding[key] * count for encoding, count in encodings)
+                / totalCount
+                if all(
+                    isinstance(encoding, dict)
+                    and SubjectShardCoordinator.isScalar(encoding.get(key))
+                    for encoding, _ in encodings
+                )
+                else value
+                for key, value in dominantEncoding.items()
+            }
+        return mergedWorkers
+
+    def exchange(self, roundIndex, taskWorkers):
+        """
+        Publish this shard's worker parameters for a round, wait for the
+        other shards and return the merged parameters of this shard's workers
+        for each task.
+        """
+        self.publish(roundIndex, taskWorkers)
+        self.waitForShards(roundIndex)
+
+        mergedTaskWorkers = {}
+        for taskLabel, workers in taskWorkers.items():
+            shardWorkers = [
+                dict(workers=workers, counts=self.annotationCounts[taskLabel])
+            ]
+            for shardIndex in range(self.numShards):
+                if shardIndex == self.shardIndex:
+                    continue
+                otherWorkers = self.readShardWorkers(taskLabel, shardIndex)
+                if otherWorkers is not None:
+                    shardWorkers.append(otherWorkers)
+            mergedTaskWorkers[taskLabel] = SubjectShardCoordinator.mergeWorkers(
+                shardWorkers, workers.keys()
+            )
+        return mergedTaskWorkers
+
+    def finish(self, roundIndex, taskWorkers):
+        """
+        Publish this shard's final worker parameters and stop the other shards
+        from waiting for it.
+        """
+        self.publish(roundIndex, taskWorkers, finished=True)
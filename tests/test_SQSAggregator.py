@@ -0,0 +1,78 @@
+import pytest
+
+pytest.importorskip("crowdsourcing")
+
+from bayesian_aggregation.LocalSQSClient import LocalSQSClient
+from bayesian_aggregation.SQSAggregator import SQSAggregator
+from bayesian_aggregation.SQSClient import SQSClient
+
+
+def makeMessages(numMessages):
+    messages = []
+    for classificationId in range(1000, 1000 + numMessages):
+        subjectId = 500 + classificationId % 7
+        classification = {
+            "id": classificationId,
+            "user_id": classificationId % 5,
+            "subject_id": subjectId,
+            "annotations": {
+                "T0": [
+                    {
+                        "task": "T0",
+                        "value": [
+                            {"x": 10.0 * (classificationId % 9), "y": 50.0, "tool": 0},
+                            {"x": 200.0, "y": 300.0, "tool": 1},
+                        ],
+                    }
+                ]
+            },
+            "metadata": {
+                "subject_dimensions": [
+                    {
+                        "clientWidth": 400,
+                        "clientHeight": 400,
+                        "naturalWidth": 400,
+                        "naturalHeight": 400,
+                    }
+                ]
+            },
+            "subject": {"id": subjectId, "metadata": {"#fwhmImagePix": 10.0}},
+        }
+        messages.append(
+            {
+                "id": classificationId,
+                "classification_id": classificationId,
+                "user_id": classification["user_id"],
+                "subject_id": subjectId,
+                "data": {"classification": classification},
+            }
+        )
+    return messages
+
+
+@pytest.mark.parametrize("prefetchBatches", [False, True])
+def test_ack_after_aggregate_deletes_duplicate_messages(tmp_path, prefetchBatches):
+    backend = LocalSQSClient()
+    SQSClient("queue", sqsBackend=backend).putMessages(makeMessages(30))
+    aggregator = SQSAggregator(
+        "queue",
+        sqsBackend=backend,
+        messageBatchSize=50,
+        taskLabels=["T0"],
+        savePath=str(tmp_path),
+        saveIntermittently=False,
+        ackAfterAggregate=True,
+        prefetchBatches=prefetchBatches,
+        visibilityTimeout=2,
+    )
+    aggregator.sqsClient.waitTimeSeconds = 0
+    aggregator.loop(verbose=False, stopOnExhaustion=True)
+
+    # Redeliver every message. None of them has a new classification.
+    SQSClient("queue", sqsBackend=backend).putMessages(makeMessages(30))
+    aggregator.loop(verbose=False, stopOnExhaustion=True)
+
+    assert aggregator.batchReceiptHandles == []
+    attributes = backend.get_queue_attributes(QueueUrl="queue")["Attributes"]
+    assert attributes["ApproximateNumberOfMessages"] == "0"
+    assert attributes["ApproximateNumberOfMessagesNotVisible"] == "0"
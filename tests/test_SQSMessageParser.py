@@ -0,0 +1,106 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from bayesian_aggregation.SQSMessageParser import SQSMessageParser
+
+
+def combinationsUniqueMarkIndices(markings, boxWidth, boxHeight):
+    """
+    The duplicate tap filter as originally applied to each classification,
+    using pairwise separations from `itertools.combinations` and `np.unique`.
+    """
+    if len(markings) <= 1:
+        return list(range(len(markings)))
+    markingSeparations = [
+        (
+            (firstId, secondId),
+            np.hypot(firstMark[0] - secondMark[0], firstMark[1] - secondMark[1]),
+        )
+        for (firstId, firstMark), (secondId, secondMark) in itertools.combinations(
+            enumerate(markings), 2
+        )
+    ]
+    return np.unique(
+        [markingSeparations[0][0][0]]
+        + [
+            idPair[1]
+            for (idPair, distance) in markingSeparations
+            if distance > 0.75 * (boxWidth + boxHeight)
+        ]
+    ).tolist()
+
+
+def assertMatchesCombinations(markings, boxWidths, boxHeights):
+    boxWidths = np.asarray(boxWidths, dtype=float)
+    boxHeights = np.asarray(boxHeights, dtype=float)
+    uniqueIndices = SQSMessageParser.uniqueMarkIndices(
+        markings, 0.75 * (boxWidths + boxHeights)
+    )
+    expectedIndices = [
+        combinationsUniqueMarkIndices(classificationMarks, boxWidth, boxHeight)
+        for classificationMarks, boxWidth, boxHeight in zip(
+            markings, boxWidths, boxHeights
+        )
+    ]
+    assert uniqueIndices == expectedIndices
+
+
+def test_no_or_single_marks():
+    assertMatchesCombinations([[], [(10.0, 20.0)], []], [35, 35, 35], [35, 35, 35])
+
+
+def test_repeated_marks():
+    markings = [
+        [(50.0, 50.0), (50.0, 50.0)],
+        [(50.0, 50.0), (50.0, 50.0), (50.0, 50.0)],
+        [(50.0, 50.0), (200.0, 200.0), (50.0, 50.0), (200.0, 200.0)],
+        [(5, 5), (5, 5), (300, 300), (300, 300), (5, 5)],
+    ]
+    assertMatchesCombinations(markings, [35] * 4, [35] * 4)
+
+
+def test_near_repeated_marks():
+    # With 10 x 10 boxes the separation threshold is 15 pixels.
+    threshold = 15.0
+    markings = [
+        # Separated by exactly the threshold, which is not enough to be kept
+        [(0.0, 0.0), (9.0, 12.0)],
+        [(0.0, 0.0), (threshold, 0.0)],
+        # Just either side of the threshold
+        [(0.0, 0.0), (np.nextafter(threshold, np.inf), 0.0)],
+        [(0.0, 0.0), (np.nextafter(threshold, 0.0), 0.0)],
+        # A chain of marks, each within the threshold of its predecessor
+        [(0.0, 0.0), (10.0, 0.0), (20.0, 0.0), (30.0, 0.0)],
+        # A near-repeat of a later mark but not of the first
+        [(0.0, 0.0), (100.0, 0.0), (101.0, 1.0), (100.5, 0.5)],
+    ]
+    assertMatchesCombinations(markings, [10] * 6, [10] * 6)
+
+
+def test_per_classification_thresholds():
+    markings = [[(0.0, 0.0), (20.0, 0.0)]] * 4
+    assertMatchesCombinations(markings, [5, 10, 20, 40], [5, 10, 20, 40])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_marks(seed):
+    randomState = np.random.RandomState(seed)
+    numClassifications = 200
+    numMarkings = randomState.randint(0, 8, size=numClassifications)
+    markings = []
+    for numMarks in numMarkings:
+        marks = randomState.uniform(0, 100, size=(numMarks, 2))
+        # Repeat some of the marks exactly and some with a small jitter
+        for mark in range(1, numMarks):
+            choice = randomState.randint(3)
+            if choice == 1:
+                marks[mark] = marks[randomState.randint(mark)]
+            elif choice == 2:
+                marks[mark] = marks[randomState.randint(mark)] + randomState.normal(
+                    scale=5, size=2
+                )
+        markings.append([tuple(mark) for mark in marks.tolist()])
+    boxSizes = randomState.choice([5.0, 10.0, 35.0], size=numClassifications)
+    assertMatchesCombinations(markings, boxSizes, boxSizes)